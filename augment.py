@@ -7,149 +7,145 @@ from PIL import Image, ImageDraw, ImageEnhance, ImageOps
 #from tensorflow.keras.preprocessing.image import random_rotation, random_shift
 
 
-def add_augment(img, policy):
-
-    shape = img.shape #shape[0]:height, shape[1]: width, shape[2]: channel
+# Kernels of the ops: kernel(img, mag, fcol) with the uint8 array img, the random
+# magnitudes are drawn for every call.
+
+def _mirror_x(img, mag, fcol):
+    return np.fliplr(img)
+
+def _mirror_y(img, mag, fcol):
+    return np.flipud(img)
+
+def _rotate_180(img, mag, fcol):
+    return np.fliplr(np.flipud(img))
+
+def _crop(img, mag, fcol):
+    shape = img.shape
+    img = Image.fromarray(img)
+    mag = mag / 10.0 * np.random.uniform(0.0, 1.0)
+    zoom = np.random.uniform(0.25 + 0.75*(1-mag)-1e-6, 1+1e-6)
+    left = np.random.uniform(0, shape[1]*np.random.uniform(1e-6, 1-zoom+1e-4)) #left
+    upper = np.random.uniform(0, shape[0]*np.random.uniform(1e-6, 1-zoom+1e-4)) #upper
+    right = left + zoom * shape[1] #right
+    lower = upper + zoom * shape[0] #lower
+    img = img.crop((left, upper, right, lower))
+    return img.resize((shape[1], shape[0]), resample=Image.BICUBIC)
+
+def _cutout_noise(img, mag, fcol):
+    shape = img.shape
+    rand = np.random.uniform(0, 1, 2)
+    blob = (np.array([rand[1]*shape[1], rand[1]*(0.5+rand[0])*shape[0]]) * mag/20.).astype('int')
+    if blob[1]*blob[0] != 0:
+        pxls = (np.random.randint(shape[1]-blob[0]-1), np.random.randint(shape[0]-blob[1]-1))
+        if shape[2] == 3:
+            blob = np.append(blob, [3])
+        noise = Image.fromarray(np.clip(np.random.randint(255, size=blob),0,255).astype('uint8'))
+        img = Image.fromarray(img)
+        img.paste(noise, pxls)
+    return img
 
-    if shape[2] == 3:
-        fcol = np.mean(img, axis=(0,1)).astype('uint8')
-        fcol_int = np.mean(img).astype('uint8')
-        fmod = 'RGB'
-        fsha = (shape[1], shape[0], 3)
+def _cutout_fill(img, mag, fcol):
+    shape = img.shape
+    img = Image.fromarray(img)
+    rand = np.random.uniform(0, 1, 2)
+    blob = (np.array([rand[1]*shape[1], rand[1]*(0.5+rand[0])*shape[0]]) * mag/20.).astype('int')
+    if blob[1]*blob[0] != 0:
+        pxls = (np.random.randint(shape[1]-blob[0]-1), np.random.randint(shape[0]-blob[1]-1))
+        draw = ImageDraw.Draw(img)
+        draw.rectangle([pxls[0], pxls[1], pxls[0]+blob[1], pxls[1]+blob[0]], fill=tuple(fcol))
+    return img
 
+def _invert(img, mag, fcol):
+    return np.invert(img)
+
+def _rotate(img, mag, fcol):
+    angle = np.random.uniform(-45, 45) * mag / 10.
+    return Image.fromarray(img).rotate(angle, resample=Image.BICUBIC, fillcolor=tuple(fcol))
+
+def _affine(img, data, fcol):
+    return Image.fromarray(img).transform((img.shape[1], img.shape[0]), Image.AFFINE, data, resample=Image.BICUBIC, fillcolor=tuple(fcol))
+
+def _shear_x(img, mag, fcol):
+    shear = np.random.uniform(-0.5, 0.5) * mag / 10.
+    return _affine(img, (1, shear, 0, 0, 1, 0), fcol)
+
+def _shear_y(img, mag, fcol):
+    shear = np.random.uniform(-0.5, 0.5) * mag / 10.
+    return _affine(img, (1, 0, 0, shear, 1, 0), fcol)
+
+def _translate_x(img, mag, fcol):
+    shift = img.shape[1] * np.random.uniform(-0.5, 0.5) * mag / 10.
+    return _affine(img, (1, 0, shift, 0, 1, 0), fcol)
+
+def _translate_y(img, mag, fcol):
+    shift = img.shape[0] * np.random.uniform(-0.5, 0.5) * mag / 10.
+    return _affine(img, (1, 0, 0, 0, 1, shift), fcol)
+
+def _autocontrast(img, mag, fcol):
+    return ImageOps.autocontrast(Image.fromarray(img), cutoff=2)
+
+def _equalize(img, mag, fcol):
+    return ImageOps.equalize(Image.fromarray(img))
+
+def _enhance(enhancer):
+    def kernel(img, mag, fcol):
+        enha = 1 + np.random.uniform(-1, 1) * mag / 10.
+        return enhancer(Image.fromarray(img)).enhance(enha)
+    return kernel
+
+def _solarize(img, mag, fcol):
+    th = int(256 * (1 - np.random.uniform(0, 1) * mag / 10.))
+    img = Image.fromarray(img)
+    if np.random.rand() - 0.5 > 0:
+        return ImageOps.solarize(img, threshold=th)
+    img = ImageOps.invert(img)
+    img = ImageOps.solarize(img, threshold=th)
+    return ImageOps.invert(img)
+
+def _posterize(img, mag, fcol):
+    bit = int(8.5 - np.random.uniform(0, 0.5) * mag)
+    return ImageOps.posterize(Image.fromarray(img), bit)
+
+AUG_OPS = {
+    'non': None,
+    'mrx': _mirror_x,
+    'mry': _mirror_y,
+    '180': _rotate_180,
+    'crp': _crop,
+    'ct1': _cutout_noise,
+    'ct2': _cutout_fill,
+    'inv': _invert,
+    'rot': _rotate,
+    'sha': _enhance(ImageEnhance.Sharpness),
+    'srx': _shear_x,
+    'sry': _shear_y,
+    'auc': _autocontrast,
+    'con': _enhance(ImageEnhance.Contrast),
+    'clr': _enhance(ImageEnhance.Color),
+    'bri': _enhance(ImageEnhance.Brightness),
+    'eqz': _equalize,
+    'tlx': _translate_x,
+    'tly': _translate_y,
+    'sol': _solarize,
+    'pos': _posterize,
+}
+
+def compile_augment(policy):
+    # list of op dicts -> list of (kernel, mag), compiled once per policy
+    chain = []
     for p in policy:
-        
-        if p['op'] == 'non':
-            pass
-        
-        # flip(mirror)
-        elif p['op'] == 'mrx':
-            img = np.fliplr(img)
-        elif p['op'] == 'mry':
-            img = np.flipud(img)
-        elif p['op'] == '180':
-            img = np.fliplr(np.flipud(img))
-        
-        #crop 
-        elif p['op'] == 'crp':
-            img = Image.fromarray(img)
-            mag = p['mag'] / 10.0 * np.random.uniform(0.0, 1.0)
-            zoom = np.random.uniform(0.25 + 0.75*(1-mag)-1e-6, 1+1e-6)
-            left = np.random.uniform(0, shape[1]*np.random.uniform(1e-6, 1-zoom+1e-4)) #left
-            upper = np.random.uniform(0, shape[0]*np.random.uniform(1e-6, 1-zoom+1e-4)) #upper
-            right = left + zoom * shape[1] #right
-            lower = upper + zoom * shape[0] #lower
-            img = img.crop((left, upper, right, lower))
-            img = img.resize((shape[1], shape[0]), resample=Image.BICUBIC)
-
-        #cutout
-        elif p['op'] == 'ct1':
-            rand = np.random.uniform(0, 1, 2)
-            blob = (np.array([rand[1]*shape[1], rand[1]*(0.5+rand[0])*shape[0]]) * p['mag']/20.).astype('int')
-            if blob[1]*blob[0] != 0:
-                pxls = (np.random.randint(shape[1]-blob[0]-1), np.random.randint(shape[0]-blob[1]-1))
-                if shape[2] == 3:
-                    blob = np.append(blob, [3])
-                noise = Image.fromarray(np.clip(np.random.randint(255, size=blob),0,255).astype('uint8'))
-                img = Image.fromarray(img)
-                img.paste(noise, pxls)
-                #img = np.asarray(img)
-
-        elif p['op'] == 'ct2':
-            img = Image.fromarray(img)
-            rand = np.random.uniform(0, 1, 2)
-            blob = (np.array([rand[1]*shape[1], rand[1]*(0.5+rand[0])*shape[0]]) * p['mag']/20.).astype('int')
-            if blob[1]*blob[0] != 0:
-                pxls = (np.random.randint(shape[1]-blob[0]-1), np.random.randint(shape[0]-blob[1]-1))
-                if img.mode == 'RGB':
-                    blob = np.append(blob, [3])
-                draw = ImageDraw.Draw(img)
-                draw.rectangle([pxls[0], pxls[1], pxls[0]+blob[1], pxls[1]+blob[0]], fill=tuple(fcol))
-
-        #invert
-        elif p['op'] == 'inv':
-            img = np.invert(img)
-
-        #rotation
-        elif p['op'] == 'rot':
-            img = Image.fromarray(img)
-            angle = np.random.uniform(-45, 45) * p['mag'] / 10.
-            img = img.rotate(angle, resample=Image.BICUBIC, fillcolor=tuple(fcol))
-
-        #sharpness
-        elif p['op'] == 'sha':
-            img = Image.fromarray(img)
-            enha  = 1 + np.random.uniform(-1, 1) * p['mag'] / 10.
-            img = ImageEnhance.Sharpness(img).enhance(enha)
-        
-        #shear
-        elif p['op'] == 'srx':
-            img = Image.fromarray(img)
-            shear = np.random.uniform(-0.5, 0.5) * p['mag'] / 10.
-            img = img.transform((shape[1], shape[0]), Image.AFFINE, (1, shear, 0, 0, 1, 0), resample=Image.BICUBIC, fillcolor=tuple(fcol))
-        elif p['op'] == 'sry':
-            img = Image.fromarray(img)
-            shear = np.random.uniform(-0.5, 0.5) * p['mag'] / 10.
-            img = img.transform((shape[1], shape[0]), Image.AFFINE, (1, 0, 0, shear, 1, 0), resample=Image.BICUBIC, fillcolor=tuple(fcol))
-        
-        #autocontrast
-        elif p['op'] == 'auc':
-            img = Image.fromarray(img)
-            img = ImageOps.autocontrast(img, cutoff=2)
-
-        #contrast
-        elif p['op'] == 'con':
-            img = Image.fromarray(img)
-            enha = 1 + np.random.uniform(-1, 1) * p['mag'] / 10.
-            img = ImageEnhance.Contrast(img).enhance(enha)
-        
-        #saturation
-        elif p['op'] == 'clr':
-            img = Image.fromarray(img)
-            enha = 1 + np.random.uniform(-1, 1) * p['mag'] / 10.
-            img = ImageEnhance.Color(img).enhance(enha)
-
-        #brightness
-        elif p['op'] == 'bri':
-            img = Image.fromarray(img)
-            enha = 1 + np.random.uniform(-1, 1) * p['mag'] / 10.
-            img = ImageEnhance.Brightness(img).enhance(enha)
-        
-        #equalize
-        elif p['op'] == 'eqz':
-            img = Image.fromarray(img)
-            img = ImageOps.equalize(img)
-
-        #translation
-        elif p['op'] == 'tlx':
-            img = Image.fromarray(img)
-            shift = shape[1] * np.random.uniform(-0.5, 0.5) * p['mag'] / 10.
-            img = img.transform((shape[1], shape[0]), Image.AFFINE, (1, 0, shift, 0, 1, 0), resample=Image.BICUBIC, fillcolor=tuple(fcol))
-        elif p['op'] == 'tly':
-            img = Image.fromarray(img)
-            shift = shape[0] * np.random.uniform(-0.5, 0.5) * p['mag'] / 10.
-            img = img.transform((shape[1], shape[0]), Image.AFFINE, (1, 0, 0, 0, 1, shift), resample=Image.BICUBIC, fillcolor=tuple(fcol))
-
-        #solarize
-        elif p['op'] == 'sol':
-            th = int(256 * (1 - np.random.uniform(0, 1) * p['mag'] / 10.))
-            img = Image.fromarray(img)
-            if np.random.rand() - 0.5 > 0:
-                img = ImageOps.solarize(img, threshold=th)
-            else:
-                img = ImageOps.invert(img)
-                img = ImageOps.solarize(img, threshold=th)
-                img = ImageOps.invert(img)
-
-        #posterize
-        elif p['op'] == 'pos':
-            bit = int(8.5 - np.random.uniform(0, 0.5) * p['mag'])
-            img = Image.fromarray(img)
-            img = ImageOps.posterize(img, bit)
-
-        
-        img = np.asarray(img, dtype=np.uint8)
+        if p['op'] not in AUG_OPS:
+            raise Exception('Unknown augment operation: %s' % (p['op']))
+        if AUG_OPS[p['op']] is not None:
+            chain.append((AUG_OPS[p['op']], p['mag']))
+    return chain
 
+def add_augment(img, policy):
+    # policy: list of op dicts or a chain of compile_augment
+    chain = policy if len(policy) == 0 or isinstance(policy[0], tuple) else compile_augment(policy)
+    fcol = np.mean(img, axis=(0,1)).astype('uint8')
+    for kernel, mag in chain:
+        img = np.asarray(kernel(img, mag, fcol), dtype=np.uint8)
     return img
 
 
@@ -1,131 +1,160 @@
-import random
-
 import numpy as np
 import PIL
 from PIL import Image, ImageDraw, ImageEnhance, ImageOps
 
 
-def add_autoaugment(img, policy):
-
-    shape = img.shape #shape[0]:height, shape[1]: width, shape[2]: channel
-
-    if shape[2] == 3:
-        fcol = tuple(np.mean(img, axis=(0,1)).astype('uint8'))
-        fmod = 'RGB'
-        #fsha = (shape[1], shape[0], 3)
-
+# Kernels of the ops: kernel(img, fcol, rng), compiled with their magnitude by the
+# factories of AUTO_OPS. 'np' kernels work on uint8 arrays, 'pil' kernels on PIL images.
+
+def _flip_kernel(mag):
+    return lambda img, fcol, rng: np.fliplr(img)
+
+def _invert_kernel(mag):
+    return lambda img, fcol, rng: np.invert(img)
+
+def _pad_crop_kernel(mag):
+    #zero-padding & random crop
+    def kernel(img, fcol, rng):
+        shape = img.shape
+        img = np.pad(img, ((4, 4), (4, 4), (0, 0)), mode='constant', constant_values=0)
+        pxl = rng.randint(8, size=2)
+        return img[pxl[0]:pxl[0]+shape[0],pxl[1]:pxl[1]+shape[1]]
+    return kernel
+
+def _affine_kernel(get_data):
+    # get_data(size, sign) -> PIL affine data, the sign is drawn for every image
+    def kernel(img, fcol, rng):
+        sign = -1. if rng.random_sample() < 0.5 else 1.
+        return img.transform(img.size, Image.AFFINE, get_data(img.size, sign), resample=Image.BICUBIC, fillcolor=fcol)
+    return kernel
+
+def _shear_x_kernel(mag):
+    shear = 0.3 * mag / 10.
+    return _affine_kernel(lambda size, sign: (1, sign * shear, 0, 0, 1, 0))
+
+def _shear_y_kernel(mag):
+    shear = 0.3 * mag / 10.
+    return _affine_kernel(lambda size, sign: (1, 0, 0, sign * shear, 1, 0))
+
+def _translate_x_kernel(mag):
+    ratio = 0.45 * mag / 10.
+    return _affine_kernel(lambda size, sign: (1, 0, sign * size[0] * ratio, 0, 1, 0))
+
+def _translate_y_kernel(mag):
+    ratio = 0.45 * mag / 10.
+    return _affine_kernel(lambda size, sign: (1, 0, 0, 0, 1, sign * size[1] * ratio))
+
+def _rotate_kernel(mag):
+    angle = 30 * mag / 10.
+    def kernel(img, fcol, rng):
+        sign = -1. if rng.random_sample() < 0.5 else 1.
+        return img.rotate(sign * angle, resample=Image.BICUBIC, fillcolor=fcol)
+    return kernel
+
+def _autocontrast_kernel(mag):
+    return lambda img, fcol, rng: ImageOps.autocontrast(img, cutoff=2)
+
+def _equalize_kernel(mag):
+    return lambda img, fcol, rng: ImageOps.equalize(img)
+
+def _solarize_kernel(mag):
+    th = int(255 * mag / 10.)
+    return lambda img, fcol, rng: ImageOps.solarize(img, threshold=th)
+
+def _posterize_kernel(mag):
+    bit = int(4 + 4 * mag / 10.)
+    return lambda img, fcol, rng: ImageOps.posterize(img, bit)
+
+def _enhance_kernel(enhancer):
+    def factory(mag):
+        enha = 0.1 + 1.8 * mag / 10.
+        return lambda img, fcol, rng: enhancer(img).enhance(enha)
+    return factory
+
+def _cutout_kernel(mag):
+    def kernel(img, fcol, rng):
+        box_size = int(img.size[1] * mag / 20.)
+        box_center = (rng.randint(img.size[0]), rng.randint(img.size[1]))
+        draw = ImageDraw.Draw(img)
+        draw.rectangle([box_center[0]-box_size, box_center[1]-box_size, box_center[0]+box_size, box_center[1]+box_size], fill=fcol)
+        return img
+    return kernel
+
+# op code -> (kind, kernel factory)
+AUTO_OPS = {
+    'inv': ('np', _invert_kernel),
+    'mrx': ('np', _flip_kernel),
+    'p&c': ('np', _pad_crop_kernel),
+    'srx': ('pil', _shear_x_kernel),
+    'sry': ('pil', _shear_y_kernel),
+    'tlx': ('pil', _translate_x_kernel),
+    'tly': ('pil', _translate_y_kernel),
+    'rot': ('pil', _rotate_kernel),
+    'auc': ('pil', _autocontrast_kernel),
+    'eqz': ('pil', _equalize_kernel),
+    'sol': ('pil', _solarize_kernel),
+    'pos': ('pil', _posterize_kernel),
+    'con': ('pil', _enhance_kernel(ImageEnhance.Contrast)),
+    'clr': ('pil', _enhance_kernel(ImageEnhance.Color)),
+    'bri': ('pil', _enhance_kernel(ImageEnhance.Brightness)),
+    'sha': ('pil', _enhance_kernel(ImageEnhance.Sharpness)),
+    'cut': ('pil', _cutout_kernel),
+}
+
+def compile_chain(policy):
+    # list of op dicts -> list of (prob, kind, kernel)
+    chain = []
     for p in policy:
-
-        if random.random() < p['prob']:
-            
-            #Numpy method
-            #invert
-            if p['op'] == 'inv':
-                img = np.invert(img)
-
-            #flip
-            elif p['op'] == 'mrx':
-                img = np.fliplr(img)
-
-            #zero-padding & random crop
-            elif p['op'] == 'p&c':
-                img = np.pad(img, ((4, 4), (4, 4), (0, 0)), mode='constant', constant_values=0)
-                pxl = np.random.randint(8, size=2)
-                img = img[pxl[0]:pxl[0]+shape[0],pxl[1]:pxl[1]+shape[1]]
-
-            #PIL method
-            else:
-                if isinstance(img, np.ndarray):
-                    img = Image.fromarray(img)
-
-                #shear
-                if p['op'] == 'srx':
-                    shear = 0.3 * p['mag'] / 10.
-                    if random.random() < 0.5:
-                        shear = -shear
-                    img = img.transform((shape[1], shape[0]), Image.AFFINE, (1, shear, 0, 0, 1, 0), resample=Image.BICUBIC, fillcolor=fcol)
-                elif p['op'] == 'sry':
-                    shear = 0.3 * p['mag'] / 10.
-                    if random.random() < 0.5:
-                        shear = -shear
-                    img = img.transform((shape[1], shape[0]), Image.AFFINE, (1, 0, 0, shear, 1, 0), resample=Image.BICUBIC, fillcolor=fcol)
-
-                #translation
-                elif p['op'] == 'tlx':
-                    shift = shape[1] * 0.45 * p['mag'] / 10.
-                    if random.random() < 0.5:
-                        shift = -shift
-                    img = img.transform((shape[1], shape[0]), Image.AFFINE, (1, 0, shift, 0, 1, 0), resample=Image.BICUBIC, fillcolor=fcol)
-                elif p['op'] == 'tly':
-                    shift = shape[0] * 0.45 * p['mag'] / 10.
-                    if random.random() < 0.5:
-                        shift = -shift
-                    img = img.transform((shape[1], shape[0]), Image.AFFINE, (1, 0, 0, 0, 1, shift), resample=Image.BICUBIC, fillcolor=fcol)
-                
-                #rotation
-                elif p['op'] == 'rot':
-                    angle = 30 * p['mag'] / 10.
-                    if random.random() < 0.5:
-                        angle = -angle
-                    img = img.rotate(angle, resample=Image.BICUBIC, fillcolor=fcol)
-
-                #autocontrast
-                elif p['op'] == 'auc':
-                    img = ImageOps.autocontrast(img, cutoff=2)
-
-                #equalize
-                elif p['op'] == 'eqz':
-                    img = ImageOps.equalize(img)        
-
-                #solarize
-                elif p['op'] == 'sol':
-                    th = int(255 * p['mag'] / 10.)
-                    img = ImageOps.solarize(img, threshold=th)
-
-                #posterize
-                elif p['op'] == 'pos':
-                    bit = int(4 + 4 * p['mag'] / 10.)
-                    img = ImageOps.posterize(img, bit)
-
-                #contrast
-                elif p['op'] == 'con':
-                    enha = 0.1 + 1.8 * p['mag'] / 10.
-                    img = ImageEnhance.Contrast(img).enhance(enha)
-                
-                #saturation
-                elif p['op'] == 'clr':
-                    enha = 0.1 + 1.8 * p['mag'] / 10.
-                    img = ImageEnhance.Color(img).enhance(enha)
-
-                #brightness
-                elif p['op'] == 'bri':
-                    enha = 0.1 + 1.8 * p['mag'] / 10.
-                    img = ImageEnhance.Brightness(img).enhance(enha)
-                
-                #sharpness
-                elif p['op'] == 'sha':
-                    enha = 0.1 + 1.8 * p['mag'] / 10.
-                    img = ImageEnhance.Sharpness(img).enhance(enha)
-
-                #cutout
-                elif p['op'] == 'cut':
-                    #mag = 1 - p['mag'] / 10.
-                    #pxls = (np.random.randint(int(shape[1]*mag)), np.random.randint(int(shape[0]*mag)))
-                    box_size = int(shape[0] * p['mag'] / 20.)
-                    box_center = (np.random.randint(shape[1]), np.random.randint(shape[0]))
-                    box_w1 = box_center[0]-box_size
-                    box_h1 = box_center[1]-box_size
-                    box_w2 = box_center[0]+box_size
-                    box_h2 = box_center[1]+box_size
-                    draw = ImageDraw.Draw(img)
-                    draw.rectangle([box_w1, box_h1, box_w2, box_h2], fill=tuple(fcol))
-
-                else:
-                    raise Exception('Unknown augment operation: %s' % (p['op']))
-            
-    img = np.asarray(img, dtype=np.uint8)
-
-    return img
+        if p['op'] not in AUTO_OPS:
+            raise Exception('Unknown augment operation: %s' % (p['op']))
+        kind, factory = AUTO_OPS[p['op']]
+        chain.append((p['prob'], kind, factory(p['mag'])))
+    return chain
+
+def apply_chain(img, chain, rng=np.random):
+    fcol = tuple(np.mean(img, axis=(0,1)).astype('uint8'))
+    for prob, kind, kernel in chain:
+        if rng.random_sample() < prob:
+            if kind == 'np' and not isinstance(img, np.ndarray):
+                img = np.asarray(img)
+            elif kind == 'pil' and isinstance(img, np.ndarray):
+                img = Image.fromarray(img)
+            img = kernel(img, fcol, rng)
+    return np.asarray(img, dtype=np.uint8)
+
+def add_autoaugment(img, policy, rng=np.random):
+    return apply_chain(img, compile_chain(policy), rng=rng)
+
+
+def get_policy_wrap(aug_pol):
+    # ops before and after the sub-policy of every image
+    if 'cifar' in aug_pol:
+        prefix = [{'op': 'mrx', 'prob': 0.5, 'mag': 0}, {'op': 'p&c', 'prob': 1.0, 'mag': 0}]
+        suffix = [{'op': 'cut', 'prob': 1, 'mag': 5}]
+    elif 'svhn' in aug_pol:
+        prefix = []
+        suffix = [{'op': 'cut', 'prob': 1.0, 'mag': 6.25}]
+    else:
+        raise Exception('Unknown policy: %s' % (aug_pol))
+    return prefix, suffix
+
+
+class Compiled_Policy(object):
+    # The policies of get_auto_policies(aug_pol) with the ops of get_policy_wrap,
+    # compiled once. augment() only draws the sub-policy and runs its chain.
+
+    def __init__(self, aug_pol, policies=None):
+        self.aug_pol = aug_pol
+        policies = get_auto_policies(aug_pol) if policies is None else policies
+        prefix, suffix = get_policy_wrap(aug_pol)
+        sub_policies = [] if 'base' in aug_pol else policies
+        self.chains = [compile_chain(list(prefix) + list(sub) + list(suffix)) for sub in sub_policies]
+        if len(self.chains) == 0:
+            self.chains = [compile_chain(list(prefix) + list(suffix))]
+
+    def augment(self, img, rng=np.random):
+        chain = self.chains[rng.randint(len(self.chains))] if len(self.chains) > 1 else self.chains[0]
+        return apply_chain(img, chain, rng=rng)
 
 
 def get_auto_policies(name):
@@ -0,0 +1,131 @@
+"""
+    Vectorized version of autoaugment.add_autoaugment for whole uint8 batches of
+    shape (B, H, W, C). The sub-policy of every image is sampled at once, then the
+    policies are applied stage by stage: at each stage the images are grouped by
+    their op, flips, pad & crop, inversion and cutout are NumPy ops on the group,
+    shear, translation and rotation are one ImageProjectiveTransformV3 call for all
+    images of the stage, the color ops are the lookup-table kernels of color_ops.
+
+    The results follow the same distribution as add_autoaugment, they are not
+    bit-identical: the affine ops interpolate bilinear instead of bicubic.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+import color_ops
+from autoaugment import get_policy_wrap
+
+AFFINE_OPS = ['srx', 'sry', 'tlx', 'tly', 'rot']
+
+
+def sample_policies(policies, aug_pol, batch_size, rng=np.random):
+    # Vectorized data_generator.creat_new_policy, a list of stages with one op per image
+    if 'base' in aug_pol or len(policies) == 0:
+        sub_stages = []
+    else:
+        policy_idx = rng.randint(len(policies), size=batch_size)
+        sub_stages = [[policies[idx][k] for idx in policy_idx] for k in range(len(policies[0]))]
+
+    prefix, suffix = get_policy_wrap(aug_pol)
+    return [[p] * batch_size for p in prefix] + sub_stages + [[p] * batch_size for p in suffix]
+
+def flip(x):
+    return x[:, :, ::-1]
+
+def pad_crop(x, rng=np.random, pad=4):
+    num, height, width = x.shape[:3]
+    x_pad = np.pad(x, ((0, 0), (pad, pad), (pad, pad), (0, 0)), mode='constant', constant_values=0)
+    offsets = rng.randint(2 * pad, size=(num, 2))
+    rows = offsets[:, 0, None] + np.arange(height)
+    cols = offsets[:, 1, None] + np.arange(width)
+    return x_pad[np.arange(num)[:, None, None], rows[:, :, None], cols[:, None, :]]
+
+def cutout(x, mags, fcol, rng=np.random):
+    # boxes of +-int(H*mag/20) pixels around a random center, filled with the mean color
+    num, height, width = x.shape[:3]
+    box_size = (height * np.asarray(mags) / 20.).astype(int)
+    center_w = rng.randint(width, size=num)
+    center_h = rng.randint(height, size=num)
+    in_h = np.abs(np.arange(height)[None, :] - center_h[:, None]) <= box_size[:, None]
+    in_w = np.abs(np.arange(width)[None, :] - center_w[:, None]) <= box_size[:, None]
+    mask = in_h[:, :, None] & in_w[:, None, :]
+    return np.where(mask[..., None], fcol[:, None, None, :], x)
+
+def get_affine_transform(op, mag, sign, shape):
+    # inverse mapping (output -> input pixel) as PIL.Image.transform and Image.rotate,
+    # converted to the pixel coordinates of ImageProjectiveTransformV3
+    height, width = shape[:2]
+    if op == 'srx':
+        data = [1, sign * 0.3 * mag / 10., 0, 0, 1, 0]
+    elif op == 'sry':
+        data = [1, 0, 0, sign * 0.3 * mag / 10., 1, 0]
+    elif op == 'tlx':
+        data = [1, 0, sign * width * 0.45 * mag / 10., 0, 1, 0]
+    elif op == 'tly':
+        data = [1, 0, 0, 0, 1, sign * height * 0.45 * mag / 10.]
+    elif op == 'rot':
+        angle = -np.deg2rad(sign * 30 * mag / 10.)
+        center_x, center_y = width / 2., height / 2.
+        a, b, d, e = np.cos(angle), np.sin(angle), -np.sin(angle), np.cos(angle)
+        data = [a, b, a * -center_x + b * -center_y + center_x, d, e, d * -center_x + e * -center_y + center_y]
+    else:
+        raise Exception('Unknown affine operation: %s' % (op))
+    return pil_to_tf_transform(data)
+
+def pil_to_tf_transform(data):
+    # PIL samples at pixel centers (x + 0.5, y + 0.5), TF at integer coordinates, so the
+    # pivot (w/2, h/2) of PIL is ((w-1)/2, (h-1)/2) in TF
+    a, b, c, d, e, f = data
+    return [a, b, c + 0.5 * (a + b - 1), d, e, f + 0.5 * (d + e - 1)]
+
+def affine(x, transforms, fcol):
+    # Out-of-image pixels get the mean color: the transform works on x - fcol with fill 0.
+    shift = fcol[:, None, None, :].astype(np.float32)
+    images = tf.convert_to_tensor(x.astype(np.float32) - shift)
+    transforms = np.concatenate([np.asarray(transforms, dtype=np.float32), np.zeros((len(x), 2), dtype=np.float32)], axis=1)
+    out = tf.raw_ops.ImageProjectiveTransformV3(images=images, transforms=transforms, output_shape=x.shape[1:3],
+                                                fill_value=0., interpolation='BILINEAR', fill_mode='CONSTANT')
+    return np.clip(np.rint(out.numpy() + shift), 0, 255).astype(np.uint8)
+
+def apply_stage(x, stage, fcol, rng=np.random):
+    num = len(x)
+    ops = np.array([p['op'] for p in stage])
+    mags = np.array([p['mag'] for p in stage], dtype=np.float32)
+    probs = np.array([p['prob'] for p in stage], dtype=np.float32)
+    active = rng.random_sample(num) < probs
+
+    affine_idx, transforms = [], []
+    for op in np.unique(ops[active]):
+        idx = np.where(active & (ops == op))[0]
+        if op == 'inv':
+            x[idx] = np.invert(x[idx])
+        elif op == 'mrx':
+            x[idx] = flip(x[idx])
+        elif op == 'p&c':
+            x[idx] = pad_crop(x[idx], rng=rng)
+        elif op == 'cut':
+            x[idx] = cutout(x[idx], mags[idx], fcol[idx], rng=rng)
+        elif op in AFFINE_OPS:
+            signs = np.where(rng.random_sample(len(idx)) < 0.5, -1., 1.)
+            affine_idx.extend(idx)
+            transforms.extend([get_affine_transform(op, mags[i], s, x.shape[1:]) for i, s in zip(idx, signs)])
+        elif op in color_ops.COLOR_OPS:
+            for mag in np.unique(mags[idx]):
+                mag_idx = idx[mags[idx] == mag]
+                x[mag_idx] = color_ops.apply_color_op(x[mag_idx], op, mag)
+        else:
+            raise Exception('Unknown augment operation: %s' % (op))
+
+    if len(affine_idx) > 0:
+        affine_idx = np.asarray(affine_idx)
+        x[affine_idx] = affine(x[affine_idx], transforms, fcol[affine_idx])
+    return x
+
+def batch_augment(x_batch, policies, aug_pol, rng=np.random):
+    # x_batch: uint8 (B, H, W, C), returns a new augmented uint8 batch
+    x = np.array(x_batch, dtype=np.uint8)
+    fcol = np.mean(x, axis=(1, 2)).astype(np.uint8) #fill color of each image, as add_autoaugment
+    for stage in sample_policies(policies, aug_pol, len(x), rng=rng):
+        x = apply_stage(x, stage, fcol, rng=rng)
+    return x
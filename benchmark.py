@@ -0,0 +1,234 @@
+"""
+    Offline CPU benchmark of the loss-landscape hot paths on synthetic
+    CIFAR-shaped data. No dataset download and no GPU is needed, results are
+    written as JSON so that runs of different versions can be compared.
+
+    python benchmark.py --models vgg9_bn resnet20 --out_dir bench/
+    python benchmark.py --compare bench/old.json bench/new.json
+"""
+
+import os
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import timeit
+
+import h5py
+import numpy as np
+import tensorflow as tf
+
+import color_ops
+import data_generator
+import data_loader
+import direction
+import evaluation
+import tfrecord
+from autoaugment import Compiled_Policy, add_autoaugment, get_auto_policies
+from batch_augment import batch_augment
+from build_model import build_model
+from h52vtp import h5_to_vtp
+from quantization.Q_Discretization import weight_discretization
+
+MODEL_TYPES = ['vgg9_bn', 'vgg16_bn', 'resnet20', 'resnet56']
+
+
+def set_seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    tf.random.set_seed(seed)
+
+def time_it(func, repeat=3, number=1):
+    func() #warm up, i.e. tf.function tracing
+    times = timeit.repeat(func, repeat=repeat, number=number)
+    times = [t / number for t in times]
+    return {'min': min(times), 'mean': float(np.mean(times)), 'max': max(times), 'repeat': repeat, 'number': number}
+
+def bench_model(model_type, x_set, y_set, batch_size=128, repeat=3):
+    results = {}
+    model = build_model(model_type, 'cifar10', fc_type='avg', l2_reg_rate=5e-4).model
+    results['num_weights'] = int(sum([np.prod(p.shape) for p in model.weights]))
+
+    w = direction.get_weights(model)
+    d = [direction.creat_random_direction(model), direction.creat_random_direction(model)]
+    d_raw = direction.get_random_weights(w)
+    cce = tf.keras.losses.CategoricalCrossentropy(reduction=tf.keras.losses.Reduction.SUM)
+
+    results['eval_loss'] = time_it(lambda: evaluation.eval_loss(model, model_type, cce, x_set, y_set, batch_size), repeat=repeat)
+    results['eval_loss']['ips'] = len(x_set) / results['eval_loss']['min']
+    results['set_weights'] = time_it(lambda: evaluation.set_weights(model, w, d, (0.1, 0.1)), repeat=repeat)
+    results['normalize_direction'] = time_it(lambda: direction.normalize_directions_for_weights(d_raw, w), repeat=repeat)
+
+    with contextlib.redirect_stdout(io.StringIO()): #unknown layers are reported for every call
+        results['weight_discretization'] = time_it(lambda: weight_discretization(model), repeat=repeat)
+
+    tf.keras.backend.clear_session()
+    return results
+
+def bench_data(x_set, y_set, aug_pol='cifar_auto', num_aug=1000, repeat=3):
+    results = {}
+    temp_dir = tempfile.mkdtemp()
+    try:
+        record_path = os.path.join(temp_dir, 'bench.tfrecord')
+        tfrecord.write_record(record_path, x_set, y_set)
+        record_files = tfrecord.get_record_files(record_path)
+        results['extract_record'] = time_it(lambda: tfrecord.extract_record(record_files), repeat=repeat)
+        results['extract_record']['num_samples'] = len(x_set)
+
+        block_path = os.path.join(temp_dir, 'bench_block.tfrecord')
+        tfrecord.write_record(block_path, x_set, y_set, block_size=1024)
+        block_files = tfrecord.get_record_files(block_path)
+        results['extract_block_record'] = time_it(lambda: tfrecord.extract_record(block_files), repeat=repeat)
+        results['load_record_dataset'] = time_it(lambda: [_ for _ in tfrecord.load_record_dataset(block_path).batch(1024)], repeat=repeat)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    policies = get_auto_policies(aug_pol)
+    def augment():
+        for idx in range(num_aug):
+            add_autoaugment(np.copy(x_set[idx % len(x_set)]), data_generator.creat_new_policy(policies, aug_pol))
+    results['add_autoaugment'] = time_it(augment, repeat=repeat)
+    results['add_autoaugment']['ips'] = num_aug / results['add_autoaugment']['min']
+    results['add_autoaugment']['aug_pol'] = aug_pol
+
+    compiled = Compiled_Policy(aug_pol, policies)
+    results['compiled_policy'] = time_it(lambda: [compiled.augment(np.copy(x_set[idx % len(x_set)])) for idx in range(num_aug)], repeat=repeat)
+    results['compiled_policy']['ips'] = num_aug / results['compiled_policy']['min']
+
+    results['batch_augment'] = time_it(lambda: batch_augment(x_set[np.arange(num_aug) % len(x_set)], policies, aug_pol), repeat=repeat)
+    results['batch_augment']['ips'] = num_aug / results['batch_augment']['min']
+
+    return results
+
+def bench_color_ops(x_set, num_img=256, mag=5, repeat=3):
+    # every color op of color_ops against the PIL path of add_autoaugment
+    results = {}
+    x_batch = x_set[np.arange(num_img) % len(x_set)]
+    for op in color_ops.COLOR_OPS:
+        policy = [{'op': op, 'prob': 1., 'mag': mag}]
+        pil = time_it(lambda: [add_autoaugment(np.copy(x), policy) for x in x_batch], repeat=repeat)
+        lut = time_it(lambda: color_ops.apply_color_op(x_batch, op, mag), repeat=repeat)
+        results[op] = {'pil': pil, 'lut': lut, 'speedup': pil['min'] / lut['min'], 'num_img': num_img}
+    return results
+
+def bench_h5_to_vtp(dot_num=51, repeat=3):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        surf_path = os.path.join(temp_dir, 'bench_surface.h5')
+        f = h5py.File(surf_path, 'w')
+        f['xcoordinates'] = np.linspace(-1, 1, num=dot_num)
+        f['ycoordinates'] = np.linspace(-1, 1, num=dot_num)
+        f['train_loss'] = np.random.RandomState(0).uniform(0, 10, size=(dot_num, dot_num))
+        f.close()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = time_it(lambda: h5_to_vtp(surf_path, surf_name='train_loss', zmax=10), repeat=repeat)
+        results['dot_num'] = dot_num
+    finally:
+        shutil.rmtree(temp_dir)
+    return results
+
+def save_results(results, out_path):
+    temp_path = out_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+    os.replace(temp_path, out_path)
+
+def get_meta(args):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception as e:
+        print('Git commit unknown: %r' % e)
+        commit = 'unknown'
+    return {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': commit,
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'tensorflow': tf.__version__,
+        'cpu_count': os.cpu_count(),
+        'args': vars(args),
+    }
+
+def run_benchmarks(args):
+    set_seed(args.seed)
+    x_set, y_set = data_loader.load_synthetic('cifar10', split='train', size=args.num_samples, seed=args.seed)
+    y_onehot = tf.keras.utils.to_categorical(y_set, 10)
+    x_mean, x_std = data_loader.get_stats(x_set)
+    x_norm = data_generator.preprocess_input(x_set, x_mean, x_std)
+
+    results = {'meta': get_meta(args), 'data': {}, 'models': {}}
+    os.makedirs(args.out_dir, exist_ok=True)
+    out_path = os.path.join(args.out_dir, 'benchmark_' + time.strftime('%Y%m%d-%H%M%S') + '.json')
+
+    print('Benchmark data pipeline.')
+    results['data'] = bench_data(x_set, y_set, num_aug=args.num_aug, repeat=args.repeat)
+    results['data']['h5_to_vtp'] = bench_h5_to_vtp(dot_num=args.dot_num, repeat=args.repeat)
+    results['data']['color_ops'] = bench_color_ops(x_set, repeat=args.repeat)
+    save_results(results, out_path)
+
+    for model_type in args.models:
+        print('Benchmark %s.' % model_type)
+        set_seed(args.seed)
+        try:
+            results['models'][model_type] = bench_model(model_type, x_norm, y_onehot, batch_size=args.batch_size, repeat=args.repeat)
+        except Exception as e: #the other models are still benchmarked
+            print('Benchmark of %s failed: %r' % (model_type, e))
+            results['models'][model_type] = {'error': repr(e)}
+            tf.keras.backend.clear_session()
+        save_results(results, out_path) #partial results survive a crash of a later model
+    print('Results saved: %s' % out_path)
+
+    return results
+
+def _flatten(results, prefix=''):
+    flat = {}
+    for k, v in results.items():
+        if isinstance(v, dict) and 'min' in v:
+            flat[prefix + k] = v['min']
+        elif isinstance(v, dict):
+            flat.update(_flatten(v, prefix + k + '/'))
+    return flat
+
+def compare_results(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+        old = _flatten({'data': old['data'], 'models': old['models']})
+    with open(new_path) as f:
+        new = json.load(f)
+        new = _flatten({'data': new['data'], 'models': new['models']})
+
+    for name in sorted(set(old.keys()) | set(new.keys())):
+        if name in old and name in new:
+            print('%-45s %10.4fs -> %10.4fs  (x%.2f)' % (name, old[name], new[name], old[name] / new[name]))
+        else:
+            print('%-45s %s' % (name, 'only in ' + ('old' if name in old else 'new')))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the loss-landscape hot paths on synthetic data (CPU, offline)')
+    parser.add_argument('--models', nargs='+', default=MODEL_TYPES, help='Model types to benchmark')
+    parser.add_argument('--num_samples', default=2048, type=int, help='Number of synthetic CIFAR-shaped samples')
+    parser.add_argument('--num_aug', default=1000, type=int, help='Number of images for the augmentation benchmark')
+    parser.add_argument('--batch_size', default=128, type=int)
+    parser.add_argument('--dot_num', default=51, type=int, help='Grid size of the surface for h5_to_vtp')
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--seed', default=123, type=int)
+    parser.add_argument('--out_dir', default='./bench/', help='Directory of the result json files')
+    parser.add_argument('--compare', nargs=2, default=None, help='Compare two result json files instead of running')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare_results(args.compare[0], args.compare[1])
+    else:
+        run_benchmarks(args)
@@ -2,6 +2,7 @@ import os
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
+import time
 from datetime import datetime
 
 import matplotlib.pyplot as plt
@@ -57,6 +58,36 @@ def plot_result(history):
     plt.show()
 
 
+class Throughput_Callback(tf.keras.callbacks.Callback):
+    # prints the training images/sec of every epoch
+    # num_samples: samples of one epoch, the last batch may be smaller than batch_size
+
+    def __init__(self, batch_size, num_samples=None, name=''):
+        super(Throughput_Callback, self).__init__()
+        self.batch_size = batch_size
+        self.num_samples = num_samples
+        self.name = name
+        self.history = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.num_batch = 0
+        self.epoch_start = time.time()
+        self.train_end = self.epoch_start #no batches, e.g. an empty dataset
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.num_batch += 1
+        self.train_end = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_time = self.train_end - self.epoch_start #without the validation
+        num_img = self.num_batch * self.batch_size
+        if self.num_samples is not None:
+            num_img = min(num_img, self.num_samples)
+        ips = num_img / epoch_time if epoch_time > 0 else 0.
+        self.history.append(ips)
+        print('epoch %d (%s): %.1f images/sec, %.1fs' % (epoch + 1, self.name, ips, epoch_time))
+
+
 class Cyclic_LR_Scheduler():
     
     def __init__(self, initial_rate, cycle_length=33, end_rate=1e-10, drop_rate=1.):
@@ -123,7 +154,9 @@ class build_model(object):
         else:
             raise Exception('Unknown model type: %s' % model_type)
 
-    def train_model(self, optimizer=None, batch_size=128, epochs=20, load_mode='tfds', plot_history=False, add_aug=False, aug_pol='baseline', callbacks=None, workers=1):
+    def train_model(self, optimizer=None, batch_size=128, epochs=20, load_mode='tfds', plot_history=False, add_aug=False, aug_pol='baseline', callbacks=None, workers=1, batch_aug=False, tf_data=False):
+        # batch_aug: augment batch-wise in Image_Generator (see batch_augment)
+        # tf_data: feed the augmented data through a tf.data pipeline instead of Image_Generator
         
         if optimizer is None:
             self.optimizer = SGD(learning_rate=0.1)
@@ -136,10 +169,11 @@ class build_model(object):
             self.model.compile(optimizer=self.optimizer, loss=tf.keras.losses.CategoricalCrossentropy(from_logits=False), metrics=['accuracy'])
 
         x_train, y_train, x_test, y_test = data_loader.load_data(self.dataset, load_mode=load_mode)
-        x_mean = np.mean(x_train).astype('float32')
-        x_std = np.std(x_train).astype('float32')
-        if add_aug:
-            train_gen = data_generator.Image_Generator(x_train, y_train, batch_size, aug_pol, x_mean=x_mean, x_std=x_std, pre_mode=self.pre_mode)
+        x_mean, x_std = data_loader.get_stats(x_train, self.dataset, load_mode)
+        if add_aug and tf_data:
+            train_gen = data_generator.get_tf_dataset(x_train, y_train, batch_size, aug_pol, x_mean=x_mean, x_std=x_std, pre_mode=self.pre_mode)
+        elif add_aug:
+            train_gen = data_generator.Image_Generator(x_train, y_train, batch_size, aug_pol, x_mean=x_mean, x_std=x_std, pre_mode=self.pre_mode, batch_aug=batch_aug)
         else:
             #x_train = (x_train.astype('float32') - x_mean) / (x_std + 1e-7)
             x_train = data_generator.preprocess_input(x_train, x_mean, x_std, mode=self.pre_mode)
@@ -147,8 +181,13 @@ class build_model(object):
         #x_test = (x_test.astype('float32') - x_mean) / (x_std + 1e-7)
         x_test = data_generator.preprocess_input(x_test, x_mean, x_std, mode=self.pre_mode)
 
+        path = 'tf_data' if add_aug and tf_data else ('generator' if add_aug else 'array')
+        callbacks = (callbacks if callbacks is not None else []) + [Throughput_Callback(batch_size, num_samples=len(x_train), name=path)]
+
         if not add_aug:
             self.history = self.model.fit(x_train, y_train, validation_data=(x_test, y_test), epochs=epochs, batch_size=batch_size, callbacks=callbacks, workers=workers)
+        elif tf_data:
+            self.history = self.model.fit(train_gen, validation_data=(x_test, y_test), epochs=epochs, callbacks=callbacks)
         else:
             self.history = self.model.fit(train_gen, validation_data=(x_test, y_test), epochs=epochs, steps_per_epoch=len(train_gen), callbacks=callbacks, workers=workers)
         
@@ -0,0 +1,123 @@
+"""
+    Lookup-table and histogram kernels of the color ops of autoaugment for uint8
+    batches of shape (B, H, W, C). They follow the PIL.ImageOps/ImageEnhance
+    implementations that add_autoaugment uses and give the same pixels (equalize
+    uses the histogram step of current Pillow releases, total // 255).
+
+    apply_color_op(x, op, mag) takes the op codes and magnitudes of the policies.
+"""
+
+import numpy as np
+
+
+def apply_lut(x, lut):
+    # lut: (256,) for all images or (B, C, 256) per image and channel
+    if lut.ndim == 1:
+        return lut.astype(np.uint8)[x]
+    num, num_channel = lut.shape[:2]
+    idx = (np.arange(num)[:, None, None, None] * num_channel + np.arange(num_channel)) * 256 + x
+    return lut.astype(np.uint8).reshape(-1)[idx]
+
+def histogram(x):
+    # (B, C, 256) counts of every image and channel
+    num, num_channel = x.shape[0], x.shape[-1]
+    idx = (np.arange(num)[:, None, None, None] * num_channel + np.arange(num_channel)) * 256 + x
+    return np.bincount(idx.ravel(), minlength=num * num_channel * 256).reshape(num, num_channel, 256)
+
+def grayscale(x):
+    # PIL convert('L'): L = R * 299/1000 + G * 587/1000 + B * 114/1000 in fixed point
+    x = x.astype(np.int32)
+    return ((x[..., 0] * 19595 + x[..., 1] * 38470 + x[..., 2] * 7471 + 0x8000) >> 16).astype(np.uint8)
+
+def blend(degenerate, x, factor):
+    # PIL Image.blend(degenerate, x, factor) in float32 with truncation
+    degenerate = np.asarray(degenerate, dtype=np.float32)
+    out = degenerate + np.float32(factor) * (x.astype(np.float32) - degenerate)
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+def posterize(x, bits):
+    lut = np.arange(256) & ~(2**(8 - bits) - 1)
+    return apply_lut(x, lut)
+
+def solarize(x, threshold):
+    lut = np.arange(256)
+    lut = np.where(lut < threshold, lut, 255 - lut)
+    return apply_lut(x, lut)
+
+def autocontrast(x, cutoff=2):
+    # ImageOps.autocontrast: cutoff % of the pixels are removed from both ends of the
+    # histogram, the rest is stretched to [0, 255], per image and channel
+    hist = histogram(x)
+    cut = (np.sum(hist, axis=2, keepdims=True) * cutoff) // 100
+    lo = np.argmax(np.cumsum(hist, axis=2) > cut, axis=2)
+    hi = 255 - np.argmax(np.cumsum(hist[:, :, ::-1], axis=2) > cut, axis=2)
+
+    valid = hi > lo
+    scale = 255.0 / np.where(valid, hi - lo, 1)
+    offset = -lo * scale
+    lut = np.trunc(np.arange(256) * scale[..., None] + offset[..., None])
+    lut = np.where(valid[..., None], np.clip(lut, 0, 255), np.arange(256))
+    return apply_lut(x, lut)
+
+def equalize(x):
+    # ImageOps.equalize, per image and channel
+    hist = histogram(x).astype(np.int64)
+    last = 255 - np.argmax(hist[:, :, ::-1] > 0, axis=2)
+    last_count = np.take_along_axis(hist, last[..., None], axis=2)[..., 0]
+    step = (np.sum(hist, axis=2) - last_count) // 255
+
+    valid = step > 0 #also false for a single color
+    safe_step = np.where(valid, step, 1)[..., None]
+    cum = np.cumsum(hist, axis=2) - hist #pixels below each value
+    lut = (safe_step // 2 + cum) // safe_step
+    lut = np.where(valid[..., None], np.minimum(lut, 255), np.arange(256))
+    return apply_lut(x, lut)
+
+def brightness(x, factor):
+    return blend(0, x, factor)
+
+def contrast(x, factor):
+    # degenerate: the rounded mean of the grayscale image
+    mean = np.mean(grayscale(x), axis=(1, 2), dtype=np.float64)
+    degenerate = np.floor(mean + 0.5)[:, None, None, None]
+    return blend(degenerate, x, factor)
+
+def color(x, factor):
+    return blend(grayscale(x)[..., None], x, factor)
+
+def smooth(x):
+    # PIL ImageFilter.SMOOTH, a 3x3 kernel [[1,1,1],[1,5,1],[1,1,1]]/13, the border is kept
+    xf = x.astype(np.float32)
+    out = np.copy(xf)
+    center = xf[:, 1:-1, 1:-1]
+    total = 5 * center
+    for dh in [-1, 0, 1]:
+        for dw in [-1, 0, 1]:
+            if dh != 0 or dw != 0:
+                total = total + xf[:, 1+dh:xf.shape[1]-1+dh, 1+dw:xf.shape[2]-1+dw]
+    out[:, 1:-1, 1:-1] = np.clip(total / 13. + 0.5, 0, 255).astype(np.uint8)
+    return out.astype(np.uint8)
+
+def sharpness(x, factor):
+    return blend(smooth(x), x, factor)
+
+
+def get_factor(mag):
+    return 0.1 + 1.8 * mag / 10.
+
+# op code -> kernel(x, mag), magnitudes as autoaugment.add_autoaugment
+COLOR_OPS = {
+    'pos': lambda x, mag: posterize(x, int(4 + 4 * mag / 10.)),
+    'sol': lambda x, mag: solarize(x, int(255 * mag / 10.)),
+    'auc': lambda x, mag: autocontrast(x, cutoff=2),
+    'eqz': lambda x, mag: equalize(x),
+    'con': lambda x, mag: contrast(x, get_factor(mag)),
+    'bri': lambda x, mag: brightness(x, get_factor(mag)),
+    'clr': lambda x, mag: color(x, get_factor(mag)),
+    'sha': lambda x, mag: sharpness(x, get_factor(mag)),
+}
+
+def apply_color_op(x, op, mag):
+    if op not in COLOR_OPS:
+        raise Exception('Unknown color operation: %s' % (op))
+    return COLOR_OPS[op](x, mag)
@@ -0,0 +1,94 @@
+"""
+    Per-point throughput metrics of a surface computation.
+    evaluation.crunch (and mpi_test.py) store one dataset per metric next to the
+    losses, i.e. 'train_loss_time', 'train_loss_ips', ... with -1 for points that
+    are not yet calculated. The run settings are stored as attributes of the loss
+    dataset.
+
+    Summarize a running or finished surface file with:
+        python crunch_stats.py -f surface.h5 --loss_key train_loss
+"""
+
+import argparse
+import time
+
+import h5py
+import numpy as np
+
+# time:        wall time of one point (set_weights + eval + write)
+# ips:         evaluated images per second
+# assign_time: time of set_weights
+# data_time:   time spent slicing/reading batches inside eval_loss
+# sync_time:   time of the MPI reduction (only for MPI runs)
+METRIC_KEYS = ['time', 'ips', 'assign_time', 'data_time', 'sync_time']
+
+
+def setup_metrics(f, loss_key, shape, **attrs):
+    metrics = {}
+    for key in METRIC_KEYS:
+        name = loss_key + '_' + key
+        if name in f.keys():
+            metrics[key] = f[name][:]
+        else:
+            metrics[key] = -np.ones(shape=shape)
+            f[name] = metrics[key]
+
+    for k, v in attrs.items():
+        f[loss_key].attrs[k] = v
+
+    return metrics
+
+def write_metrics(f, loss_key, metrics):
+    for key in METRIC_KEYS:
+        f[loss_key + '_' + key][:] = metrics[key]
+
+def summarize_metrics(surf_path, loss_key='train_loss'):
+    f = h5py.File(surf_path, 'r')
+    assert loss_key in f.keys(), '%s is not in surface file: %s' % (loss_key, surf_path)
+    assert loss_key + '_time' in f.keys(), 'No metrics recorded for %s in surface file: %s' % (loss_key, surf_path)
+
+    losses = f[loss_key][:]
+    attrs = dict(f[loss_key].attrs)
+    metrics = {key: f[loss_key + '_' + key][:].ravel() for key in METRIC_KEYS}
+    f.close()
+
+    done = metrics['time'] >= 0
+    total = losses.size
+    remaining = np.sum(losses.ravel() <= 0) #same criterion as scheduler.get_unplotted_indices
+    nproc = int(attrs.get('nproc', 1))
+
+    print('------------------------------------------------------------------')
+    print('summarize_metrics: %s' % loss_key)
+    print('------------------------------------------------------------------')
+    for k, v in attrs.items():
+        print('%s: %s' % (k, v))
+    print('points done: %d/%d' % (total - remaining, total))
+
+    if not np.any(done):
+        print('No finished points yet.')
+        return None
+
+    point_time = metrics['time'][done]
+    p50, p95 = np.percentile(point_time, [50, 95])
+    print('point latency p50: %.3fs, p95: %.3fs, mean: %.3fs' % (p50, p95, np.mean(point_time)))
+    print('images/sec p50: %.1f' % (np.percentile(metrics['ips'][done], 50)))
+    for key in ['assign_time', 'data_time', 'sync_time']:
+        vals = metrics[key][done & (metrics[key] >= 0)]
+        if len(vals) > 0:
+            print('%s p50: %.3fs, p95: %.3fs' % (key, np.percentile(vals, 50), np.percentile(vals, 95)))
+
+    eta = remaining * np.mean(point_time) / nproc
+    print('estimated time to completion: %.1fs (%d points, %d procs)' % (eta, remaining, nproc))
+    if 'start_time' in attrs and remaining > 0:
+        print('estimated finish: %s' % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() + eta)))
+
+    return {'done': int(total - remaining), 'total': int(total), 'p50': float(p50), 'p95': float(p95), 'eta': float(eta)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the per-point metrics of a surface file')
+    parser.add_argument('--surf_file', '-f', default='', help='The h5 file that contains surface values')
+    parser.add_argument('--loss_key', default='train_loss', help='train_loss | test_loss')
+    args = parser.parse_args()
+
+    summarize_metrics(args.surf_file, loss_key=args.loss_key)
@@ -2,20 +2,21 @@ import os
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
-import glob
 import math
-import random
-import string
+import multiprocessing
+import shutil
+import time
+from multiprocessing import shared_memory
 
-import h5py
 import numpy as np
 import tensorflow as tf
 
 import data_loader
 #import h5_util
-import tfrecord
 #from augment import add_augment, get_policies
-from autoaugment import add_autoaugment, get_auto_policies
+from autoaugment import Compiled_Policy, get_auto_policies, get_policy_wrap
+from batch_augment import batch_augment
+from tf_augment import augment_batch, get_policy_tables
 
 
 class Image_Generator(tf.keras.utils.Sequence):
@@ -28,46 +29,51 @@ class Image_Generator(tf.keras.utils.Sequence):
         aug_pol,
         x_mean=None,
         x_std=None,
-        pre_mode='norm'
+        pre_mode='norm',
+        batch_aug=False
         ):
+        # batch_aug: augment each batch at once with batch_augment instead of image by image
+        # x_set, y_set can be read-only (e.g. cached memmaps), they are only read by index
 
         self.x_set = x_set
         self.y_set = y_set
         self.batch_size = batch_size
         self.policies = get_auto_policies(aug_pol)
+        self.compiled = Compiled_Policy(aug_pol, self.policies)
         self.aug_pol = aug_pol
         self.pre_mode = pre_mode
+        self.batch_aug = batch_aug
+        self.indices = np.arange(len(x_set)) #sample order of the epoch, see _shuffle
         #self._set_probs()
 
-        if x_mean is None:
-            self.x_mean = np.mean(x_set).astype('float32')
-        else:
-            self.x_mean = x_mean
-
-        if x_std is None:
-            self.x_std = np.std(x_set).astype('float32')
-        else:
-            self.x_std = x_std
+        if x_mean is None or x_std is None:
+            x_mean, x_std = data_loader.get_stats(x_set)
+        self.x_mean = x_mean
+        self.x_std = x_std
 
     def __len__(self):
         return math.ceil(len(self.x_set) / self.batch_size)
 
     def __getitem__(self, step_idx):
-        
-        y_batch = self.y_set[self.batch_size * step_idx : self.batch_size * (step_idx + 1)]
+        # samples of the batch in the current permutation, sorted for sequential reads
+        # from a memmap, x_set and y_set themselves are never reordered
+        idx = np.sort(self.indices[self.batch_size * step_idx : self.batch_size * (step_idx + 1)])
+        y_batch = np.asarray(self.y_set[idx])
+
+        if self.batch_aug:
+            x_batch = batch_augment(self.x_set[idx], self.policies, self.aug_pol)
+            x_batch = preprocess_input(x_batch, self.x_mean, self.x_std, mode=self.pre_mode)
+            return x_batch, y_batch
 
         x_batch = []
-        for x_idx, idx in enumerate(range(self.batch_size * step_idx, min(self.batch_size * (step_idx + 1), len(self.x_set)))):
-            x = np.copy(self.x_set[idx])
-            new_policy = creat_new_policy(self.policies, self.aug_pol)
-            x = add_autoaugment(x, new_policy)
+        for i in idx:
+            x = self.compiled.augment(np.copy(self.x_set[i]))
             x = np.asarray(x, dtype=np.float32)
             x_batch.append(x)
 
         #x_batch = np.asarray(x_batch)
         #x_batch = (x_batch - self.x_mean) / (self.x_std + 1e-7)
         x_batch = preprocess_input(x_batch, self.x_mean, self.x_std, mode=self.pre_mode)
-        y_batch = np.asarray(y_batch)
 
         return x_batch, y_batch
         
@@ -80,86 +86,190 @@ class Image_Generator(tf.keras.utils.Sequence):
             self.probs.append([p.get('prob') for p in policy])
 
     def _shuffle(self):
-        shuffle_list = np.arange(self.x_set.shape[0])
-        np.random.shuffle(shuffle_list)
-        self.x_set = self.x_set[shuffle_list]
-        self.y_set = self.y_set[shuffle_list]
+        np.random.shuffle(self.indices)
+
+preprocess_chunk = 4096 #samples per chunk of preprocess_input
+
+def get_tf_dataset(x_set, y_set, batch_size, aug_pol, x_mean=None, x_std=None, pre_mode='norm', shuffle=True):
+    # tf.data version of Image_Generator: the dataset holds only the sample indices, the
+    # batches are gathered from x_set (can be a memmap, hence the numpy_function), then
+    # augmented (tf_augment) and normalized with TF ops in parallel map calls.
+    if x_mean is None or x_std is None:
+        x_mean, x_std = data_loader.get_stats(x_set)
+    if pre_mode == 'norm':
+        shift, denom = np.float32(x_mean), np.float32(x_std + 1e-7)
+    elif pre_mode == 'scale':
+        shift, denom = np.float32(128.), np.float32(32.)
+    else:
+        raise Exception('Unknown preprocess mode: %s' % pre_mode)
+    tables = get_policy_tables(aug_pol)
+    num_class = y_set.shape[1]
+
+    def load_batch(idx):
+        idx = np.sort(idx) #sequential reads from a memmap
+        return np.asarray(x_set[idx], dtype=np.uint8), np.asarray(y_set[idx], dtype=np.float32)
+
+    def gather_batch(idx):
+        x_batch, y_batch = tf.numpy_function(load_batch, [idx], [tf.uint8, tf.float32])
+        x_batch.set_shape((None,) + tuple(x_set.shape[1:]))
+        y_batch.set_shape((None, num_class))
+        return x_batch, y_batch
 
-def preprocess_input(img, img_mean, img_std, mode='norm'):
+    def augment(x_batch, y_batch):
+        x_batch = augment_batch(x_batch, tables)
+        return (tf.cast(x_batch, tf.float32) - shift) / denom, y_batch
+
+    dataset = tf.data.Dataset.range(len(x_set))
+    if shuffle:
+        dataset = dataset.shuffle(len(x_set), reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size).map(gather_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.map(augment, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+def preprocess_input(img, img_mean, img_std, mode='norm', out=None, chunk_size=None):
+    # Converts and normalizes chunk by chunk into one float32 array, img (e.g. a uint8
+    # memmap) is never copied as a whole. out: preallocated float32 array of the shape
+    # of img, can be img itself for an in-place normalization of a float32 array.
     if mode == 'norm':
-        img = (np.array(img, dtype=np.float32) - img_mean) / (img_std + 1e-7)
+        shift, denom = img_mean, img_std + 1e-7
     elif mode == 'scale':
-        img = (np.array(img, dtype=np.float32) - 128.) / 32.
+        shift, denom = 128., 32.
     else:
         raise Exception('Unknown preprocess mode: %s' % mode)
-    return img
+
+    if not isinstance(img, np.ndarray): #e.g. a list of images
+        img = np.asarray(img, dtype=np.float32)
+        out = img if out is None else out
+    if out is None:
+        out = np.empty(img.shape, dtype=np.float32)
+    assert out.shape == img.shape and out.dtype == np.float32, 'out must be a float32 array of shape %s.' % str(img.shape)
+
+    chunk_size = preprocess_chunk if chunk_size is None else chunk_size
+    for start in range(0, len(out), chunk_size):
+        chunk = out[start:start+chunk_size]
+        chunk[...] = img[start:start+chunk_size]
+        np.subtract(chunk, shift, out=chunk, casting='unsafe')
+        np.divide(chunk, denom, out=chunk, casting='unsafe')
+    return out
         
-def set_temp_dataset(dataset, load_mode, aug_pol, pre_mode='norm'):
-    x_train, y_train, _, _ = data_loader.load_data(dataset, load_mode=load_mode)
-    x_mean = np.mean(x_train).astype('float32')
-    x_std = np.std(x_train).astype('float32')
-    shuffle_list = np.arange(x_train.shape[0])
-    np.random.shuffle(shuffle_list)
-    x_train = x_train[shuffle_list]
-    y_train = y_train[shuffle_list]
+aug_worker_data = {} #x_set and Compiled_Policy of the set_temp_dataset workers
+
+def share_array(x_set):
+    # (spec, shm): spec opens x_set in another process without pickling the data. A
+    # whole .npy memmap is opened from its file, other arrays are copied once into
+    # shared memory shm, which the caller has to close and unlink.
+    if isinstance(x_set, np.memmap) and x_set.filename is not None and x_set.flags.c_contiguous \
+            and x_set.offset + x_set.nbytes == os.path.getsize(x_set.filename):
+        return ('memmap', x_set.filename, x_set.offset, x_set.dtype.str, x_set.shape), None
+    x_set = np.ascontiguousarray(x_set)
+    shm = shared_memory.SharedMemory(create=True, size=max(x_set.nbytes, 1))
+    np.ndarray(x_set.shape, dtype=x_set.dtype, buffer=shm.buf)[...] = x_set
+    return ('shm', shm.name, 0, x_set.dtype.str, x_set.shape), shm
+
+def open_shared_array(spec):
+    # (array, shm) of a share_array spec, shm has to stay open while the array is used
+    kind, name, offset, dtype, shape = spec
+    if kind == 'memmap':
+        return np.memmap(name, dtype=dtype, mode='r', offset=offset, shape=shape), None
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+def _init_aug_worker(x_spec, aug_pol):
+    aug_worker_data['x_set'], aug_worker_data['shm'] = open_shared_array(x_spec)
+    aug_worker_data['compiled'] = Compiled_Policy(aug_pol)
+
+def _augment_chunk(args):
+    # augments x_set[sample_idx], sample i with its own RandomState([seed, i]), so the
+    # result does not depend on the chunking or the number of workers
+    start, sample_idx, seed = args
+    x_set, compiled = aug_worker_data['x_set'], aug_worker_data['compiled']
+    x_aug = np.empty((len(sample_idx),) + x_set.shape[1:], dtype=np.uint8)
+    for k, idx in enumerate(sample_idx):
+        x_aug[k] = compiled.augment(np.copy(x_set[idx]), rng=np.random.RandomState([seed, idx]))
+    return start, x_aug
+
+def augment_dataset(x_set, aug_pol, seed, order=None, num_workers=None, chunk_size=1024, out=None):
+    # uint8 array of the augmented samples x_set[order] in a process pool
+    # out: preallocated uint8 array (e.g. a memmap) for the result
+    order = np.arange(len(x_set)) if order is None else order
+    num_workers = (os.cpu_count() or 1) if num_workers is None else num_workers
+    tasks = [(start, order[start:start+chunk_size], seed) for start in range(0, len(order), chunk_size)]
+    x_aug = np.empty((len(order),) + x_set.shape[1:], dtype=np.uint8) if out is None else out
+
+    start_time = time.time()
+    pool, shm = None, None
+    if num_workers > 1:
+        x_spec, shm = share_array(x_set) #the workers do not get a pickled copy of x_set
+        pool = multiprocessing.Pool(num_workers, initializer=_init_aug_worker, initargs=(x_spec, aug_pol))
+        results = pool.imap_unordered(_augment_chunk, tasks)
+    else:
+        aug_worker_data['x_set'], aug_worker_data['compiled'] = x_set, Compiled_Policy(aug_pol)
+        results = map(_augment_chunk, tasks)
+
+    try:
+        done, next_report = 0, 0.1
+        for start, x_chunk in results:
+            x_aug[start:start+len(x_chunk)] = x_chunk
+            done += len(x_chunk)
+            if done / len(order) >= next_report or done == len(order):
+                aug_time = time.time() - start_time
+                print('%d/%d images augmented in %.2fs (%.1f images/sec)' % (done, len(order), aug_time, done / aug_time))
+                next_report += 0.1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+        aug_worker_data.clear()
+    return x_aug
+
+def set_temp_dataset(dataset, load_mode, aug_pol, seed=None, num_workers=None):
+    # Materializes the augmented train set as uint8 in the augmentation cache of
+    # data_loader and returns its path. An existing set of the same dataset, load_mode,
+    # aug_pol and seed is reused. seed: shuffling and augmentation, random if None.
+    # num_workers: processes of augment_dataset, the result is the same for any number
+    seed = np.random.randint(2**31) if seed is None else seed
+    temp_path = data_loader.get_aug_cache_path(dataset, load_mode, aug_pol, seed)
+    if data_loader.read_aug_cache(temp_path) is not None:
+        print('Augmented dataset found in cache: %s' % temp_path)
+        return temp_path
 
+    x_train, y_train, _, _ = data_loader.load_data(dataset, load_mode=load_mode)
+    x_mean, x_std = data_loader.get_stats(x_train, dataset, load_mode)
+    shuffle_list = np.random.RandomState(seed).permutation(x_train.shape[0])
+    num_class = int(y_train.shape[1]) if y_train.ndim == 2 else int(np.max(y_train)) + 1
     y_train = np.argmax(y_train, axis=1) if y_train.ndim == 2 else y_train
 
-    temp_file_name = 'temp_' + dataset + '_' + aug_pol + '_' + ''.join(random.choices(string.ascii_lowercase + string.digits, k=3)) + '.tfrecord'
-    temp_file_path = 'd:/dataset/temp/' + temp_file_name
-
-    policies = get_auto_policies(aug_pol)    
-    x_train_aug = []
-    for idx in range(len(x_train)):
-        x = np.copy(x_train[idx])
-        new_policy = creat_new_policy(policies, aug_pol)
-        x = add_autoaugment(x, new_policy)
-        #x = np.asarray(x, dtype=np.float32)
-        #x = (x - x_mean) / (x_std + 1e-7)
-        x = preprocess_input(x, x_mean, x_std, mode=pre_mode)
-        x_train_aug.append(x)
-
-    x_train_aug = np.asarray(x_train_aug)
-
-    '''
-    f = h5py.File(temp_file_path, 'w')
-    h5_util.write_list(f, 'x_train', x_train_aug)
-    h5_util.write_list(f, 'y_train', y_train)
-    f.close()
-    '''
-
-    tfrecord.write_record(temp_file_path, x_train_aug, y_train)
-
-    return temp_file_path
-
-def load_temp_dataset(temp_file_path):
-    '''
-    f = h5py.File(temp_file_path, 'r')
-
-    x_train = h5_util.read_list(f, 'x_train')
-    x_train = [np.asarray(x_data, dtype='float32') for x_data in x_train]
-    y_train = h5_util.read_list(f, 'y_train')
-    y_train = [np.asarray(y_data, dtype='float32') for y_data in y_train]
-
-    x_train = np.asarray(x_train)
-    y_train = np.asarray(y_train)
-
-    f.close()
-    #os.remove(temp_file_path)
-    '''
-
-    temp_file_list = glob.glob(temp_file_path + '*')
-    assert len(temp_file_list) > 0, 'Temp dataset is missing, please check!'
-    assert int(temp_file_list[0].split('-')[-1]) == len(temp_file_list), 'Several temp records are missing, please check!'
-    x_train, y_train = tfrecord.extract_record(temp_file_list)
-    y_train = tf.keras.utils.to_categorical(y_train)
+    header = {
+        'dataset': dataset,
+        'load_mode': load_mode,
+        'aug_pol': aug_pol,
+        'seed': int(seed),
+        'num_class': num_class,
+        'x_mean': np.asarray(x_mean).tolist(), #statistics of the original train set
+        'x_std': np.asarray(x_std).tolist(),
+    }
+    fill = lambda x_out: augment_dataset(x_train, aug_pol, seed, order=shuffle_list, num_workers=num_workers, out=x_out)
+    data_loader.write_aug_cache(temp_path, x_train.shape, fill, y_train[shuffle_list], header)
+
+    return temp_path
+
+def load_temp_dataset(temp_path, pre_mode='norm'):
+    # normalized float32 train set and one-hot labels of set_temp_dataset
+    cached = data_loader.read_aug_cache(temp_path)
+    assert cached is not None, 'Temp dataset is missing, please check: ' + temp_path
+    x_aug, y_train, header = cached
+    x_mean = np.asarray(header['x_mean'], dtype=np.float32)
+    x_std = np.asarray(header['x_std'], dtype=np.float32)
+    x_train = preprocess_input(x_aug, x_mean, x_std, mode=pre_mode)
+    y_train = tf.keras.utils.to_categorical(y_train, header['num_class'])
 
     return x_train, y_train
 
-def remove_temp_dataset(temp_file_path):
-    temp_file_list = glob.glob(temp_file_path + '*')
-    for temp_file in temp_file_list:
-        os.remove(temp_file)
+def remove_temp_dataset(temp_path):
+    shutil.rmtree(temp_path, ignore_errors=True)
 
 def creat_new_policy(policies, aug_pol):
 
@@ -167,23 +277,14 @@ def creat_new_policy(policies, aug_pol):
         new_policy = []
     else:
         new_policy = policies[np.random.randint(len(policies))]
-        
-    if 'cifar' in aug_pol:
-        new_policy = [{'op': 'mrx', 'prob': 0.5, 'mag': 0}, {'op': 'p&c', 'prob': 1.0, 'mag': 0}] + list(new_policy)
-        new_policy = new_policy + [{'op': 'cut', 'prob': 1, 'mag': 5}]
-
-    elif 'svhn' in aug_pol:
-        new_policy = list(new_policy) + [{'op': 'cut', 'prob': 1.0, 'mag': 6.25}]
-
-    else:
-        raise Exception('Unknown policy: %s' % (aug_pol))
 
-    return new_policy
+    prefix, suffix = get_policy_wrap(aug_pol)
+    return list(prefix) + list(new_policy) + list(suffix)
 
 
 if __name__ == "__main__":
     
-    #path = set_temp_dataset('svhn_equal', 'tfrd', 'svhn_auto')
+    #path = set_temp_dataset('svhn_equal', 'tfrd', 'svhn_auto', seed=0)
     #print(path)
-    #x_train, y_train = load_temp_dataset('d:/dataset/temp/temp_svhn_equal_svhn_auto_jw0.tfrecord')
-    remove_temp_dataset('d:/dataset/temp/temp_svhn_equal_svhn_auto_jw0.tfrecord')
+    #x_train, y_train = load_temp_dataset(path)
+    remove_temp_dataset(data_loader.get_aug_cache_path('svhn_equal', 'tfrd', 'svhn_auto', 0))
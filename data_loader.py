@@ -2,7 +2,12 @@ import os
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
-import gc
+import glob
+import hashlib
+import json
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import tensorflow as tf
@@ -13,7 +18,39 @@ import tfrecord
 
 dataset_root_path = 'd:/dataset/'
 
-def load_data(dataset, load_mode='tfds'):
+# load_mode 'synthetic': deterministic random uint8 images, no download needed.
+# (image shape, number of classes, train size, test size)
+synthetic_spec = {
+    'cifar10':     ((32, 32, 3), 10, 50000, 10000),
+    'cifar10_pre': ((32, 32, 3), 10, 50000, 10000),
+    'cifar100':    ((32, 32, 3), 100, 50000, 10000),
+    'svhn_equal':  ((32, 32, 3), 10, 73257, 26032),
+}
+synthetic_size = None #(train size, test size), overrides the sizes of synthetic_spec
+synthetic_seed = 0
+synthetic_chunk = 1024 #samples per generated chunk, every chunk has its own seed
+
+# Decoded datasets are cached as raw .npy files (uint8 images, integer labels) with a
+# json header in cache_root/<dataset>_<load_mode>/. Cached loads are read-only
+# memory maps, concurrent processes share one copy in the page cache. The cached
+# sample order is the (shuffled) order of the first load. The header holds the source
+# of the data (get_cache_source), a cache of other synthetic settings or of changed
+# files is rebuilt.
+cache_root = dataset_root_path + 'cache/'
+use_cache = False
+cache_version = 1
+
+# get_stats: per-channel (last axis) instead of global mean/std for preprocess_input
+per_channel_stats = False
+stats_chunk = 1024 #samples per chunk of the streaming statistics
+
+def load_data(dataset, load_mode='tfds', cache=None):
+    # cache: use the dataset cache, None for the module setting use_cache
+    cache = use_cache if cache is None else cache
+    if cache:
+        cached = read_cache(dataset, load_mode)
+        if cached is not None:
+            return cached
 
     x_train_list = []
     y_train_list = []
@@ -34,23 +71,10 @@ def load_data(dataset, load_mode='tfds'):
         assert os.path.exists(dataset_path), 'Dataset may not exist, please check the path: ' + dataset_path
         train_path = dataset_path + '/train/'
         test_path = dataset_path + '/test/'
-        classes = os.listdir(train_path)
-
-        gc.disable()
-        for idx, cl in enumerate(classes):
-            data_imgs = os.listdir(train_path + cl)
-            img_load = [image.load_img(train_path + cl + '/' + data_img) for data_img in data_imgs]
-            x_train_list.extend([image.img_to_array(img) for img in img_load])
-            y_train_list.extend([idx for i in range(len(data_imgs))])
-            
-            data_imgs = os.listdir(test_path + cl)
-            img_load = [image.load_img(test_path + cl + '/' + data_img) for data_img in data_imgs]
-            x_test_list.extend([image.img_to_array(img) for img in img_load])
-            y_test_list.extend([idx for i in range(len(data_imgs))])
-        gc.enable()
-
-        x_train_list = np.asarray(x_train_list, dtype=np.uint8)
-        x_test_list = np.asarray(x_test_list, dtype=np.uint8)
+        classes = sorted(os.listdir(train_path))
+
+        x_train_list, y_train_list = load_image_folder(train_path, classes)
+        x_test_list, y_test_list = load_image_folder(test_path, classes)
         y_train_list = tf.keras.utils.to_categorical(y_train_list)
         y_test_list = tf.keras.utils.to_categorical(y_test_list)
         x_train_list, y_train_list, x_test_list, y_test_list = shuffle_data(x_train_list, y_train_list, x_test_list, y_test_list)
@@ -61,26 +85,302 @@ def load_data(dataset, load_mode='tfds'):
         y_test_list = tf.keras.utils.to_categorical(y_test_list)
         x_train_list, y_train_list, x_test_list, y_test_list = shuffle_data(x_train_list, y_train_list, x_test_list, y_test_list)
 
+    elif load_mode == 'synthetic':
+        assert dataset in synthetic_spec, 'No synthetic spec for dataset: ' + dataset
+        _, num_class, train_size, test_size = synthetic_spec[dataset]
+        if synthetic_size is not None:
+            train_size, test_size = synthetic_size
+        x_train_list, y_train_list = load_synthetic(dataset, split='train', size=train_size)
+        x_test_list, y_test_list = load_synthetic(dataset, split='test', size=test_size)
+        y_train_list = tf.keras.utils.to_categorical(y_train_list, num_class)
+        y_test_list = tf.keras.utils.to_categorical(y_test_list, num_class)
+
     else:
         raise Exception('Unknown load_mode: %s' % (load_mode))
+
+    if cache:
+        write_cache(dataset, load_mode, x_train_list, y_train_list, x_test_list, y_test_list)
+        cached = read_cache(dataset, load_mode)
+        if cached is not None:
+            return cached
         
     return x_train_list, y_train_list, x_test_list, y_test_list
+
+def get_cache_path(dataset, load_mode):
+    return os.path.join(cache_root, dataset + '_' + load_mode)
+
+def read_header_file(cache_path):
+    # header of a complete cache of the current cache_version, else None
+    header_path = os.path.join(cache_path, 'header.json')
+    if not os.path.exists(header_path):
+        return None
+    with open(header_path) as f:
+        header = json.load(f)
+    if header.get('version') != cache_version:
+        return None
+    return header
+
+def read_cache_header(dataset, load_mode):
+    return read_header_file(get_cache_path(dataset, load_mode))
+
+def publish_cache(temp_path, cache_path, source=None):
+    # Moves a completely written cache directory into place, other processes never see a
+    # half written cache. Only an outdated cache (other version or source) is replaced, a
+    # valid one published by a concurrent process is kept and the new copy is dropped.
+    # False if it was dropped.
+    header = read_header_file(cache_path) if os.path.exists(cache_path) else None
+    if os.path.exists(cache_path) and (header is None or (source is not None and header.get('source') != source)):
+        shutil.rmtree(cache_path, ignore_errors=True)
+    try:
+        os.replace(temp_path, cache_path)
+        return True
+    except OSError: #written by another process at the same time
+        shutil.rmtree(temp_path, ignore_errors=True)
+        return False
+
+def write_cache_header(dataset, load_mode, header):
+    header_path = os.path.join(get_cache_path(dataset, load_mode), 'header.json')
+    temp_path = header_path + '.%d.tmp' % os.getpid()
+    with open(temp_path, 'w') as f:
+        json.dump(header, f, indent=4)
+    os.replace(temp_path, header_path)
+
+def get_files_fingerprint(file_list):
+    # hash of the names, sizes and modification times of the files
+    h = hashlib.sha1()
+    for path in sorted(file_list):
+        stat = os.stat(path)
+        h.update(('%s %d %d\n' % (os.path.relpath(path, dataset_root_path), stat.st_size, stat.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+def get_cache_source(dataset, load_mode):
+    # what the data of load_data(dataset, load_mode) is generated or decoded from
+    if load_mode == 'synthetic':
+        shape, _, train_size, test_size = synthetic_spec[dataset]
+        size = synthetic_size if synthetic_size is not None else (train_size, test_size)
+        return {'shape': list(shape), 'size': list(size), 'seed': synthetic_seed, 'chunk': synthetic_chunk}
+    elif load_mode == 'path':
+        dataset_path = dataset_root_path + dataset
+        file_list = [os.path.join(root, name) for root, _, names in os.walk(dataset_path) for name in names]
+        return {'files': len(file_list), 'fingerprint': get_files_fingerprint(file_list)}
+    elif load_mode == 'tfrd':
+        file_list = glob.glob(dataset_root_path + 'tfrd/' + dataset + '-*.tfrecord*')
+        return {'files': len(file_list), 'fingerprint': get_files_fingerprint(file_list)}
+    return {'name': dataset}
+
+def read_cache(dataset, load_mode):
+    # None if the dataset is not cached or the cache is of other source data
+    header = read_cache_header(dataset, load_mode)
+    if header is None or header.get('source') != get_cache_source(dataset, load_mode):
+        return None
+    cache_path = get_cache_path(dataset, load_mode)
+    data = []
+    for split in ['train', 'test']:
+        x_set = np.load(os.path.join(cache_path, 'x_' + split + '.npy'), mmap_mode='r')
+        y_set = np.load(os.path.join(cache_path, 'y_' + split + '.npy'))
+        data.extend([x_set, tf.keras.utils.to_categorical(y_set, header['num_class'])])
+    return tuple(data)
+
+def write_cache(dataset, load_mode, x_train_list, y_train_list, x_test_list, y_test_list):
+    cache_path = get_cache_path(dataset, load_mode)
+    temp_path = cache_path + '.%d.tmp' % os.getpid()
+    os.makedirs(temp_path, exist_ok=True)
+    source = get_cache_source(dataset, load_mode)
+
+    y_train = np.argmax(y_train_list, axis=1) if y_train_list.ndim == 2 else y_train_list
+    y_test = np.argmax(y_test_list, axis=1) if y_test_list.ndim == 2 else y_test_list
+    np.save(os.path.join(temp_path, 'x_train.npy'), np.asarray(x_train_list, dtype=np.uint8))
+    np.save(os.path.join(temp_path, 'y_train.npy'), y_train.astype(np.int64))
+    np.save(os.path.join(temp_path, 'x_test.npy'), np.asarray(x_test_list, dtype=np.uint8))
+    np.save(os.path.join(temp_path, 'y_test.npy'), y_test.astype(np.int64))
+
+    header = {
+        'version': cache_version,
+        'dataset': dataset,
+        'load_mode': load_mode,
+        'num_class': int(y_train_list.shape[1]) if y_train_list.ndim == 2 else int(np.max(y_train)) + 1,
+        'train_shape': list(x_train_list.shape),
+        'test_shape': list(x_test_list.shape),
+        'source': source,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    with open(os.path.join(temp_path, 'header.json'), 'w') as f:
+        json.dump(header, f, indent=4)
+
+    if publish_cache(temp_path, cache_path, source=source):
+        print('Dataset cached: %s' % cache_path)
+
+def remove_cache(dataset, load_mode):
+    shutil.rmtree(get_cache_path(dataset, load_mode), ignore_errors=True)
+
+# Augmented train sets (data_generator.set_temp_dataset) are cached the same way as
+# uint8 images before normalization in cache_root/<dataset>_<load_mode>_<aug_pol>_<seed>/,
+# runs and MPI ranks with the same key share one materialized set.
+def get_aug_cache_path(dataset, load_mode, aug_pol, seed):
+    return get_cache_path(dataset, load_mode) + '_%s_%d' % (aug_pol, seed)
+
+def read_aug_cache(cache_path):
+    # (x_train as read-only memmap, y_train labels, header), None if not cached
+    header = read_header_file(cache_path)
+    if header is None:
+        return None
+    x_set = np.load(os.path.join(cache_path, 'x_train.npy'), mmap_mode='r')
+    y_set = np.load(os.path.join(cache_path, 'y_train.npy'))
+    return x_set, y_set, header
+
+def write_aug_cache(cache_path, shape, fill, y_train, header):
+    # fill(x_out) writes the uint8 images into the memmap x_out of the given shape,
+    # so the augmented set is never held in memory as a whole
+    temp_path = cache_path + '.%d.tmp' % os.getpid()
+    os.makedirs(temp_path, exist_ok=True)
+
+    x_out = np.lib.format.open_memmap(os.path.join(temp_path, 'x_train.npy'), mode='w+', dtype=np.uint8, shape=tuple(shape))
+    fill(x_out)
+    x_out.flush()
+    del x_out
+    np.save(os.path.join(temp_path, 'y_train.npy'), np.asarray(y_train, dtype=np.int64))
+
+    header = dict(header, version=cache_version, train_shape=list(shape), created=time.strftime('%Y-%m-%d %H:%M:%S'))
+    with open(os.path.join(temp_path, 'header.json'), 'w') as f:
+        json.dump(header, f, indent=4)
+
+    if publish_cache(temp_path, cache_path):
+        print('Augmented dataset cached: %s' % cache_path)
+
+def compute_stats(x_set, chunk_size=None):
+    # Mean and std (ddof=0, as np.std) in one streaming pass, the per-channel statistics
+    # of the chunks are merged with Chan's parallel form of Welford's algorithm, so only
+    # one float64 chunk is held in memory.
+    chunk_size = stats_chunk if chunk_size is None else chunk_size
+    num_channel = x_set.shape[-1] if np.ndim(x_set) == 4 else 1
+    count = 0
+    mean = np.zeros(num_channel)
+    m2 = np.zeros(num_channel)
+    for start in range(0, len(x_set), chunk_size):
+        chunk = np.asarray(x_set[start:start+chunk_size], dtype=np.float64).reshape(-1, num_channel)
+        chunk_count = len(chunk)
+        chunk_mean = np.mean(chunk, axis=0)
+        chunk_m2 = np.sum(np.square(chunk - chunk_mean), axis=0)
+        delta = chunk_mean - mean
+        total = count + chunk_count
+        mean = mean + delta * (chunk_count / total)
+        m2 = m2 + chunk_m2 + np.square(delta) * (count * chunk_count / total)
+        count = total
+
+    global_mean = np.mean(mean) #the channels have the same count
+    global_m2 = np.sum(m2) + count * np.sum(np.square(mean - global_mean))
+    return {
+        'num_samples': len(x_set),
+        'mean': float(global_mean),
+        'std': float(np.sqrt(global_m2 / (count * num_channel))),
+        'channel_mean': mean.tolist(),
+        'channel_std': np.sqrt(m2 / count).tolist(),
+    }
+
+def get_stats(x_train, dataset=None, load_mode=None, per_channel=None):
+    # (mean, std) for preprocess_input as float32, per channel as arrays.
+    # With dataset/load_mode of a cached dataset (x_train is its train split) the
+    # statistics are computed once and stored in the cache header.
+    per_channel = per_channel_stats if per_channel is None else per_channel
+    header = read_cache_header(dataset, load_mode) if dataset is not None else None
+
+    if header is not None and header.get('stats', {}).get('num_samples') == len(x_train):
+        stats = header['stats']
+    else:
+        stats = compute_stats(x_train)
+        if header is not None:
+            header['stats'] = stats
+            write_cache_header(dataset, load_mode, header)
+
+    if per_channel:
+        return np.asarray(stats['channel_mean'], dtype=np.float32), np.asarray(stats['channel_std'], dtype=np.float32)
+    return np.float32(stats['mean']), np.float32(stats['std'])
+
+def load_image_folder(split_path, classes, num_workers=None):
+    # Decodes <split_path>/<class>/<image> with a thread pool straight into one
+    # preallocated uint8 array, all images must have the same size.
+    file_list, label_list = [], []
+    for idx, cl in enumerate(classes):
+        data_imgs = sorted(os.listdir(split_path + cl))
+        file_list.extend([split_path + cl + '/' + data_img for data_img in data_imgs])
+        label_list.extend([idx] * len(data_imgs))
+    assert len(file_list) > 0, 'No images found in: ' + split_path
+
+    start_time = time.time()
+    shape = np.asarray(image.load_img(file_list[0])).shape
+    x_set = np.empty((len(file_list),) + shape, dtype=np.uint8)
+
+    def decode(start):
+        # one task per chunk of 256 files, executor.map has no chunking for threads
+        for idx in range(start, min(start + 256, len(file_list))):
+            x_set[idx] = np.asarray(image.load_img(file_list[idx]), dtype=np.uint8)
+
+    num_workers = (os.cpu_count() or 1) * 2 if num_workers is None else num_workers #decoding is partly I/O bound
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(decode, range(0, len(file_list), 256)))
+
+    load_time = time.time() - start_time
+    print('%d images loaded from %s in %.2fs (%.1f files/sec)' % (len(file_list), split_path, load_time, len(file_list) / load_time))
+    return x_set, np.asarray(label_list, dtype=np.int64)
+
+def synthetic_chunks(dataset, split='train', size=None, seed=None):
+    shape, num_class, train_size, test_size = synthetic_spec[dataset]
+    if size is None:
+        size = train_size if split == 'train' else test_size
+    if seed is None:
+        seed = synthetic_seed
+    split_id = ['train', 'test'].index(split)
+
+    # The samples only depend on (seed, split, chunk index), so the first n samples
+    # are the same for every size.
+    for chunk_idx, start in enumerate(range(0, size, synthetic_chunk)):
+        num = min(synthetic_chunk, size - start)
+        rng = np.random.RandomState([seed, split_id, chunk_idx])
+        x_chunk = rng.randint(0, 256, size=(num,) + shape, dtype=np.uint8)
+        y_chunk = rng.randint(0, num_class, size=num)
+        yield x_chunk, y_chunk
+
+def load_synthetic(dataset, split='train', size=None, seed=None):
+    shape, _, train_size, test_size = synthetic_spec[dataset]
+    if size is None:
+        size = train_size if split == 'train' else test_size
+
+    x_set = np.empty((size,) + shape, dtype=np.uint8)
+    y_set = np.empty((size,), dtype=np.int64)
+    start = 0
+    for x_chunk, y_chunk in synthetic_chunks(dataset, split=split, size=size, seed=seed):
+        x_set[start:start+len(x_chunk)] = x_chunk
+        y_set[start:start+len(y_chunk)] = y_chunk
+        start += len(x_chunk)
+
+    return x_set, y_set
             
+def shuffle_in_place(*arrays):
+    # Shuffles arrays of the same length with the same permutation, writable arrays in
+    # place row by row (np.random.shuffle with the same RNG state gives the same
+    # permutation for the same length), read-only arrays (e.g. cached memmaps) as copies.
+    state = np.random.get_state()
+    perm = None
+    shuffled = []
+    for array in arrays:
+        if isinstance(array, np.ndarray) and array.flags.writeable:
+            np.random.set_state(state)
+            np.random.shuffle(array)
+        else:
+            if perm is None:
+                np.random.set_state(state)
+                perm = np.random.permutation(len(array))
+            array = array[perm]
+        shuffled.append(array)
+    return shuffled
+
 def shuffle_data(x_train_list, y_train_list, x_test_list, y_test_list):
-    train_shuffle = np.arange(x_train_list.shape[0])
-    test_shuffle = np.arange(x_test_list.shape[0])
-    np.random.shuffle(train_shuffle)
-    np.random.shuffle(test_shuffle)
-    x_train_list = x_train_list[train_shuffle]
-    y_train_list = y_train_list[train_shuffle]
-    x_test_list = x_test_list[test_shuffle]
-    y_test_list = y_test_list[test_shuffle]
+    x_train_list, y_train_list = shuffle_in_place(x_train_list, y_train_list)
+    x_test_list, y_test_list = shuffle_in_place(x_test_list, y_test_list)
     return x_train_list, y_train_list, x_test_list, y_test_list
 
-
 if __name__ == "__main__":
 
-    import time
     import matplotlib.pyplot as plt
 
     start_time = time.time()
@@ -3,6 +3,8 @@ import os
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
 import copy
+import glob
+import re
 
 import h5py
 import numpy as np
@@ -11,44 +13,230 @@ from tensorflow.keras.models import load_model
 
 import h5_util
 
-def creat_random_direction(model):
+def creat_random_direction(model, norm='filter', ignore='biasbn', generator=None):
     weights = get_weights(model)
-    direction = get_random_weights(weights)
-    norm_direction = normalize_directions_for_weights(direction, weights)
+    direction = get_random_weights(weights, generator=generator)
+    norm_direction = normalize_directions_for_weights(direction, weights, norm=norm, ignore=ignore)
     return norm_direction
 
+def creat_seed_direction(weights, seed, axis=0, norm='filter', ignore='biasbn'):
+    # Counter-based (philox) random direction: the random values of layer i only depend
+    # on (seed, i, axis), so every process can regenerate the same normalized direction
+    # layer by layer from the seed instead of reading a direction file.
+    direction = [get_layer_random_weights(w.shape, seed, idx, axis=axis) for idx, w in enumerate(weights)]
+    return normalize_directions_for_weights(direction, weights, norm=norm, ignore=ignore)
+
+def write_random_direction(f, name, model, seed=None, axis=0, norm='filter', ignore='biasbn', flat=False, dtype='float32', compression=None):
+    # Streaming version of creat_seed_direction: the direction is drawn, normalized and
+    # written to the h5 file one layer at a time, so next to the model only about the
+    # size of the largest layer is held in memory.
+    # flat: write the flat format of h5_util.create_flat with the given dtype/compression
+    if seed is None: #drawn from the global seed, so tf.random.set_seed still applies
+        seed = int(tf.random.uniform([], maxval=2**31-1, dtype=tf.int64))
+
+    scale = None
+    if norm == 'model': #first pass for the norms of the whole model
+        d_sq, w_sq = 0., 0.
+        for idx, p in enumerate(model.weights):
+            if len(p.shape) > 1:
+                d_sq += np.sum(np.square(get_layer_random_weights(p.shape, seed, idx, axis=axis), dtype=np.float64))
+                w_sq += np.sum(np.square(p.numpy(), dtype=np.float64))
+        scale = np.float32(np.sqrt(w_sq) / (np.sqrt(d_sq) + 1e-10))
+
+    if flat:
+        grp = h5_util.create_flat(f, name, [tuple(p.shape) for p in model.weights], dtype=dtype, compression=compression)
+    else:
+        grp = f.create_group(name)
+    for idx, p in enumerate(model.weights):
+        w = tf.convert_to_tensor(p)
+        d = get_layer_random_weights(w.shape, seed, idx, axis=axis)
+        norm_d = normalize_layer_direction(d, w, norm=norm, ignore=ignore, scale=scale)
+        if flat:
+            h5_util.write_flat_item(grp, idx, norm_d)
+        else:
+            h5_util.write_item(grp, idx, norm_d)
+        del w, d, norm_d
+    grp.attrs['seed'] = seed
+    grp.attrs['norm'] = norm
+    f.flush()
+
+    return seed
+
 def creat_target_direction(weights1, weights2):
     return [w2 - w1 for (w1, w2) in zip(weights1, weights2)]
 
+def get_checkpoint_paths(checkpoint_pattern):
+    # ModelCheckpoint files of train_script.py, '..._{epoch:03d}_{val_accuracy:.4f}_weights.h5', sorted by epoch
+    epoch_pattern = re.compile(r'_(\d+)_\d\.\d+_weights\.h5$')
+    paths = [path for path in glob.glob(checkpoint_pattern) if epoch_pattern.search(path)]
+    assert len(paths) > 0, 'No checkpoints found: ' + checkpoint_pattern
+    return sorted(paths, key=lambda path: int(epoch_pattern.search(path).group(1)))
+
+def get_flat_weights(model, ignore='biasbn'):
+    flat = np.concatenate([p.numpy().ravel() for p in model.weights]).astype(np.float32)
+    if ignore == 'biasbn':
+        flat[get_biasbn_mask(model)] = 0.
+    return flat
+
+def get_biasbn_mask(model):
+    return np.concatenate([np.full(int(np.prod(p.shape)), len(p.shape) <= 1) for p in model.weights])
+
+def unflatten_weights(flat, model):
+    direction, start = [], 0
+    for p in model.weights:
+        size = int(np.prod(p.shape))
+        direction.append(tf.convert_to_tensor(flat[start:start+size].reshape(p.shape), dtype=tf.float32))
+        start += size
+    return direction
+
+def gram_svd(a):
+    # SVD of a matrix with few rows and very many columns through its Gram matrix
+    gram = np.dot(a, a.T).astype(np.float64)
+    s2, u = np.linalg.eigh(gram)
+    order = np.argsort(s2)[::-1]
+    s = np.sqrt(np.maximum(s2[order], 0.))
+    u = u[:, order]
+    vt = np.dot(u.T, a) / (s[:, None] + 1e-30)
+    return s, vt.astype(np.float32)
+
+def incremental_pca(vectors, n_components=2, batch_size=4):
+    # Incremental PCA (Ross et al. 2008, as sklearn.decomposition.IncrementalPCA) over
+    # an iterable of 1D vectors, only batch_size vectors are held in memory at a time.
+    assert batch_size >= n_components, 'batch_size must not be smaller than n_components.'
+    n_seen, mean, total_ss = 0, None, 0.
+    components, s = None, None
+
+    def update(batch):
+        nonlocal n_seen, mean, total_ss, components, s
+        x = np.asarray(batch, dtype=np.float32)
+        n_batch = len(x)
+        n_total = n_seen + n_batch
+        batch_mean = np.mean(x, axis=0)
+        x_c = x - batch_mean
+        batch_ss = float(np.sum(np.square(x_c, dtype=np.float64)))
+        if n_seen == 0:
+            a = x_c
+            total_ss = batch_ss
+            mean = batch_mean
+        else:
+            mean_diff = mean - batch_mean
+            correction = np.sqrt(n_seen * n_batch / n_total) * mean_diff
+            a = np.vstack((s[:, None] * components, x_c, correction[None, :]))
+            total_ss += batch_ss + n_seen * n_batch / n_total * float(np.sum(np.square(mean_diff, dtype=np.float64)))
+            mean = mean + (batch_mean - mean) * (n_batch / n_total)
+        s_new, vt = gram_svd(a)
+        components, s = vt[:n_components], s_new[:n_components]
+        n_seen = n_total
+
+    batch = []
+    for v in vectors:
+        batch.append(v)
+        if len(batch) == batch_size:
+            update(batch)
+            batch = []
+    if len(batch) > 0:
+        update(batch)
+    assert len(components) == n_components, 'Not enough checkpoints for %d components.' % n_components
+
+    explained_variance_ratio = np.square(s) / (total_ss + 1e-30)
+    return components, explained_variance_ratio
+
+def write_pca_direction(f, model, checkpoint_paths, proj_path=None, n_components=2, batch_size=4, ignore='biasbn'):
+    # Trajectory PCA directions: the top principal directions of w_i - w_final over the
+    # checkpoints w_i, with w_final the current weights of the model. The checkpoints are
+    # streamed, and projected onto the directions for plot_2D.plot_2d_contour(proj_path=...).
+    w_final = get_weights(model)
+    flat_final = get_flat_weights(model, ignore=ignore)
+
+    def trajectory():
+        for path in checkpoint_paths:
+            model.load_weights(path)
+            yield get_flat_weights(model, ignore=ignore) - flat_final
+
+    components, explained_variance_ratio = incremental_pca(trajectory(), n_components=n_components, batch_size=batch_size)
+    for idx, w in enumerate(w_final):
+        model.weights[idx].assign(w)
+    print('PCA explained variance ratio: %s' % str(explained_variance_ratio))
+
+    for name, component in zip(['xdirection', 'ydirection'], components):
+        h5_util.write_list(f, name, unflatten_weights(component, model))
+    f.attrs['explained_variance_ratio'] = explained_variance_ratio
+    f.flush()
+
+    if proj_path is not None:
+        coords = np.array([np.dot(components, v) for v in trajectory()])
+        for idx, w in enumerate(w_final):
+            model.weights[idx].assign(w)
+
+        fp = h5py.File(proj_path, 'w')
+        fp['proj_xcoord'] = coords[:, 0]
+        if n_components > 1:
+            fp['proj_ycoord'] = coords[:, 1]
+        fp['checkpoints'] = np.array([os.path.basename(path) for path in checkpoint_paths], dtype='S')
+        fp.attrs['explained_variance_ratio'] = explained_variance_ratio
+        fp.close()
+        print('Projected trajectory saved: %s' % proj_path)
+
+    return explained_variance_ratio
+
 def get_weights(model):
     return [tf.convert_to_tensor(p) for p in model.weights]
 
-def get_random_weights(weights):
-    return [tf.random.normal(w.shape) for w in weights]
+def get_random_weights(weights, generator=None):
+    if generator is None:
+        return [tf.random.normal(w.shape) for w in weights]
+    return [generator.normal(w.shape) for w in weights]
 
-def normalize_directions_for_weights(direction, weights):
+def get_layer_random_weights(shape, seed, layer_idx, axis=0):
+    # axis 0: x direction, axis 1: y direction
+    return tf.random.stateless_normal(shape, seed=[seed, 2 * layer_idx + axis], alg='philox')
+
+def normalize_directions_for_weights(direction, weights, norm='filter', ignore='biasbn'):
     assert(len(direction) == len(weights))
-    norm_direction = []
-    for d, w in zip(direction, weights):
-        if len(d.shape) <= 1:
-            norm_direction.append(tf.zeros_like(d))
+    scale = get_model_scale(direction, weights) if norm == 'model' else None
+    return [normalize_layer_direction(d, w, norm=norm, ignore=ignore, scale=scale) for d, w in zip(direction, weights)]
+
+def get_model_scale(direction, weights):
+    d_norm = np.sqrt(np.sum([np.sum(np.square(d, dtype=np.float64)) for d in direction if len(d.shape) > 1]))
+    w_norm = np.sqrt(np.sum([np.sum(np.square(w, dtype=np.float64)) for w in weights if len(w.shape) > 1]))
+    return np.float32(w_norm / (d_norm + 1e-10))
+
+def normalize_layer_direction(d, w, norm='filter', ignore='biasbn', scale=None):
+    # ignore='biasbn': no perturbation of biases and BN parameters (all 1D weights)
+    # ignore=None: 1D weights are perturbed along the weights themselves
+    # scale: ||weights|| / ||direction|| of the whole model for norm='model'
+    if len(d.shape) <= 1:
+        if ignore == 'biasbn':
+            return tf.zeros_like(d)
+        elif ignore is None:
+            return tf.identity(w)
         else:
-            norm_direction.append(normalize_direction(d, w))
-    return norm_direction
+            raise Exception('Unknown ignore mode: %s' % (ignore))
+    elif norm == 'model':
+        return tf.convert_to_tensor(np.asarray(d) * scale)
+    else:
+        return normalize_direction(d, w, norm=norm)
 
-def normalize_direction(direction, weights):
-    direction_filter = np.transpose(direction)
-    weights_filter = np.transpose(weights)
+def normalize_direction(direction, weights, norm='filter'):
+    direction = np.asarray(direction)
+    weights = np.asarray(weights)
 
-    norm_direction_list = []
-    for d, w in zip(direction_filter, weights_filter):
-        d_filter = d * np.linalg.norm(w) / (np.linalg.norm(d) + 1e-10)
-        norm_direction_list.append(d_filter)
-    
-    filter_norm_direction = np.transpose(np.asarray(norm_direction_list))
-    filter_norm_direction = tf.convert_to_tensor(filter_norm_direction)
+    if norm == 'filter':
+        # One filter per output channel (last axis). The norms are computed as batched
+        # dot products over the filters in their original element order, which gives
+        # bit-identical results to np.linalg.norm on every single filter.
+        out = direction.shape[-1]
+        d_filter = np.ascontiguousarray(direction.reshape(-1, out).T)[:, None, :]
+        w_filter = np.ascontiguousarray(weights.reshape(-1, out).T)[:, None, :]
+        d_norm = np.sqrt(np.matmul(d_filter, d_filter.transpose(0, 2, 1)).ravel())
+        w_norm = np.sqrt(np.matmul(w_filter, w_filter.transpose(0, 2, 1)).ravel())
+        norm_direction = direction * w_norm / (d_norm + 1e-10)
+    elif norm == 'layer':
+        norm_direction = direction * np.linalg.norm(weights) / (np.linalg.norm(direction) + 1e-10)
+    else:
+        raise Exception('Unknown norm mode: %s' % (norm))
 
-    return filter_norm_direction
+    return tf.convert_to_tensor(norm_direction)
 
 if __name__ == "__main__":
 
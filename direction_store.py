@@ -0,0 +1,82 @@
+"""
+    Content-addressed store of random direction files.
+    A direction file is identified by a hash of the model architecture and weights,
+    the RNG seed, the normalization mode and the ignored layers. Requesting an
+    existing key returns the stored file without generating the directions again.
+"""
+
+import os
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+
+import hashlib
+import json
+import shutil
+
+import h5py
+
+import direction
+import h5_util
+
+store_root = './models/directions/'
+
+
+def get_model_hash(model):
+    h = hashlib.sha1()
+    h.update(model.to_json().encode())
+    for p in model.weights:
+        h.update(str(p.shape).encode())
+        h.update(p.numpy().tobytes())
+    return h.hexdigest()
+
+def get_direction_key(model_hash, seed, norm='filter', ignore='biasbn', dtype='float32', flat=False, compression=None):
+    config = {'model': model_hash, 'seed': seed, 'norm': norm, 'ignore': ignore, 'rng': 'philox', 'dtype': dtype}
+    if flat or compression is not None: #keys of list-format files stay the same
+        config['flat'] = flat
+        config['compression'] = compression
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+def get_direction(model, seed, set_y=True, norm='filter', ignore='biasbn', root=None, mmap=False, flat=False, dtype='float32', compression=None):
+    # Returns the path of the direction file of this model/seed/norm/ignore, the
+    # directions are only created if the key is not in the store yet.
+    # With mmap=True the memory-mapped directions are returned as well.
+    # flat, dtype, compression: storage format, see h5_util.create_flat
+    assert seed is not None, 'The direction store needs a seed, random directions cannot be reused.'
+    root = store_root if root is None else root
+    os.makedirs(root, exist_ok=True)
+
+    model_hash = get_model_hash(model)
+    key = get_direction_key(model_hash, seed, norm=norm, ignore=ignore, dtype=dtype, flat=flat, compression=compression)
+    dir_path = os.path.join(root, key + '.h5')
+    names = ['xdirection', 'ydirection'] if set_y else ['xdirection']
+
+    if os.path.exists(dir_path):
+        f = h5py.File(dir_path, 'r')
+        missing = [name for name in names if name not in f.keys()]
+        f.close()
+    else:
+        missing = names
+
+    if len(missing) == 0:
+        print("Direction file found in store: %s" % dir_path)
+    else:
+        # x and y are independent counter-based streams of the same seed, so a missing
+        # y direction can be added later to a copy, readers keep the stored file meanwhile.
+        temp_path = dir_path + '.%d.tmp' % os.getpid()
+        if os.path.exists(dir_path):
+            shutil.copyfile(dir_path, temp_path)
+        f = h5py.File(temp_path, 'a')
+        for name in missing:
+            direction.write_random_direction(f, name, model, seed=seed, axis=names.index(name), norm=norm, ignore=ignore,
+                                             flat=flat, dtype=dtype, compression=compression)
+        f.attrs['model_hash'] = model_hash
+        f.attrs['seed'] = seed
+        f.attrs['norm'] = norm
+        f.attrs['ignore'] = str(ignore)
+        f.close()
+        os.replace(temp_path, dir_path) #other processes never see a half written file
+        print("Direction file created in store: %s" % dir_path)
+
+    if mmap:
+        return dir_path, [h5_util.read_list_mmap(dir_path, name) for name in names]
+    return dir_path
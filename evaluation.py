@@ -10,9 +10,11 @@ import h5py
 import numpy as np
 import tensorflow as tf
 
+import crunch_stats
 import data_loader
 import direction
 import h5_util
+from tracer import Stage_Tracer
 from quantization.build_vgg_qn import f_convert_model, CUSTOM_OBJ
 from quantization.Q_Discretization import weight_discretization
 
@@ -34,17 +36,21 @@ def setup_surface_file(surf_path, dir_path, set_y, num=51, l_range=(-1, 1)):
 
     f.close()
 
-def load_directions(dir_path):
+def load_directions(dir_path, mmap=False, weights=None):
+    # weights: needed for directions that are stored as their seed only
     f = h5py.File(dir_path, 'r')
-
-    xdirections_data = h5_util.read_list(f, 'xdirection')
-    if 'ydirection' in f.keys():
-        ydirections_data = h5_util.read_list(f, 'ydirection')
-        xdirections = [tf.convert_to_tensor(xdata) for xdata in xdirections_data]
-        ydirections = [tf.convert_to_tensor(ydata) for ydata in ydirections_data]
-        directions = [xdirections, ydirections]
-    else:
-        directions = [[tf.convert_to_tensor(xdata) for xdata in xdirections_data]]
+    names = ['xdirection', 'ydirection'] if 'ydirection' in f.keys() else ['xdirection']
+
+    directions = []
+    for name in names:
+        seed_info = h5_util.read_seed(f, name)
+        if seed_info is not None:
+            assert weights is not None, 'Direction %s is stored as seed, weights are needed to regenerate it.' % name
+            directions.append(direction.creat_seed_direction(weights, **seed_info))
+        elif mmap: #read-only memory-mapped views, no copy in memory
+            directions.append(h5_util.read_list_mmap(dir_path, name))
+        else:
+            directions.append([tf.convert_to_tensor(data) for data in h5_util.read_list(f, name)])
 
     f.close()
     return directions
@@ -61,7 +67,7 @@ def set_weights(model, weights, directions=None, step=None):
     for idx in range(len(weights)):
         model.weights[idx].assign(weights[idx] + tf.convert_to_tensor(changes[idx]))
 
-def eval_loss(model, model_type, cce, x_set, y_set, batch_size, from_logits=False, add_reg=True):
+def eval_loss(model, model_type, cce, x_set, y_set, batch_size, from_logits=False, add_reg=True, stats=None):
     total = len(x_set)
     step_num = math.ceil(total / batch_size)
     total_loss = 0
@@ -71,21 +77,38 @@ def eval_loss(model, model_type, cce, x_set, y_set, batch_size, from_logits=Fals
     if len(model.losses) > 0 and ('qn' not in model_type) and add_reg:
         reg_loss = np.sum(model.losses)
 
+    data_time = 0.
+    eval_start = time.time()
     for idx in range(step_num):
-        x = x_set[batch_size*idx:batch_size*(idx+1)]
-        y = y_set[batch_size*idx:batch_size*(idx+1)]
+        data_start = time.time()
+        #materialization (e.g. memmap reads) and tensor conversion, not only the slice views
+        x = tf.convert_to_tensor(np.asarray(x_set[batch_size*idx:batch_size*(idx+1)]))
+        y = tf.convert_to_tensor(np.asarray(y_set[batch_size*idx:batch_size*(idx+1)]))
+        data_time += time.time() - data_start
         out = model(x, training=False)
         total_loss += cce(y, out).numpy()
         eq = tf.math.equal(tf.math.argmax(out, axis=1), tf.math.argmax(y, axis=1))
         correct += np.sum(eq)
     loss = total_loss / total + reg_loss
     acc = 1.*correct/total
+
+    if stats is not None:
+        stats['data_time'] = data_time
+        stats['eval_time'] = time.time() - eval_start
     #print('loss: %f, acc: %f' % (loss, acc))
     #sys.stdout.flush()
     return loss, acc
 
-def crunch(surf_path, model, model_type, w, d, x_set, y_set, loss_key, acc_key, batch_size=128, add_reg=True, L_A=[3, 5], L_W=[1, 7]):
-    
+def crunch(surf_path, model, model_type, w, d, x_set, y_set, loss_key, acc_key, batch_size=128, add_reg=True, L_A=[3, 5], L_W=[1, 7],
+           trace_dir=None, trace_points=None, tracer=None):
+    # trace_dir: write stage timings/memory and a tf.profiler trace to this directory
+    # trace_points: (start, stop) grid point indices of the tf.profiler trace window
+    # tracer: Stage_Tracer shared with the caller, overrides trace_dir/trace_points
+
+    own_tracer = tracer is None
+    if own_tracer:
+        tracer = Stage_Tracer(trace_dir, trace_points)
+
     f = h5py.File(surf_path, 'r+')
     losses, accuracies = [], []
     xcoordinates = f['xcoordinates'][:]
@@ -97,6 +120,11 @@ def crunch(surf_path, model, model_type, w, d, x_set, y_set, loss_key, acc_key,
         accuracies = -np.ones(shape=shape)
         f[loss_key] = losses
         f[acc_key] = accuracies
+    else:
+        losses = f[loss_key][:]
+        accuracies = f[acc_key][:]
+
+    metrics = crunch_stats.setup_metrics(f, loss_key, losses.shape, batch_size=batch_size, num_samples=len(x_set), model_type=model_type, nproc=1, start_time=time.time())
 
     if 'qn' in model_type:
         from_logits = True
@@ -116,30 +144,46 @@ def crunch(surf_path, model, model_type, w, d, x_set, y_set, loss_key, acc_key,
         coords = xcoordinates
 
     for idx, coord in enumerate(coords):
-        set_weights(model, w, d, coord)
-        if 'qn' in model_type:
-            #L_A=[3, 5] #[3, 5]
-            #L_W=[1, 7] #[1, 7]
-            model_conv = f_convert_model(model, tf.keras.optimizers.Nadam(), L_W=L_W, L_A=L_A, custom_obj=CUSTOM_OBJ)
-            model_conv = weight_discretization(model_conv, L_CONV=L_W, L_FC=L_W)
-            loss, acc = eval_loss(model_conv, model_type, cce, x_set, y_set, batch_size, from_logits=from_logits, add_reg=add_reg)
-            del model_conv
-        else:
-            loss, acc = eval_loss(model, model_type, cce, x_set, y_set, batch_size, from_logits=from_logits, add_reg=add_reg)
-
-        tf.keras.backend.clear_session()
+        tracer.point_begin(idx)
+        point_start = time.time()
+        with tracer.stage('set_weights'):
+            set_weights(model, w, d, coord)
+        assign_time = time.time() - point_start
+        stats = {}
+        with tracer.stage('eval'):
+            if 'qn' in model_type:
+                #L_A=[3, 5] #[3, 5]
+                #L_W=[1, 7] #[1, 7]
+                model_conv = f_convert_model(model, tf.keras.optimizers.Nadam(), L_W=L_W, L_A=L_A, custom_obj=CUSTOM_OBJ)
+                model_conv = weight_discretization(model_conv, L_CONV=L_W, L_FC=L_W)
+                loss, acc = eval_loss(model_conv, model_type, cce, x_set, y_set, batch_size, from_logits=from_logits, add_reg=add_reg, stats=stats)
+                del model_conv
+            else:
+                loss, acc = eval_loss(model, model_type, cce, x_set, y_set, batch_size, from_logits=from_logits, add_reg=add_reg, stats=stats)
+
+            tf.keras.backend.clear_session()
 
         losses.ravel()[idx] = loss
         accuracies.ravel()[idx] = acc
 
-        f[loss_key][:] = losses
-        f[acc_key][:] = accuracies
-        f.flush()
+        metrics['assign_time'].ravel()[idx] = assign_time
+        metrics['data_time'].ravel()[idx] = stats['data_time']
+        metrics['ips'].ravel()[idx] = len(x_set) / stats['eval_time']
+
+        with tracer.stage('write'):
+            f[loss_key][:] = losses
+            f[acc_key][:] = accuracies
+            metrics['time'].ravel()[idx] = time.time() - point_start
+            crunch_stats.write_metrics(f, loss_key, metrics)
+            f.flush()
 
-        print('coord=%s, \tloss: %f, acc: %f' % (str(coord), loss, acc))
+        print('coord=%s, \tloss: %f, acc: %f, \ttime=%.2f' % (str(coord), loss, acc, metrics['time'].ravel()[idx]))
         sys.stdout.flush()
 
     f.close()
+    tracer.stop_profiler()
+    if own_tracer:
+        tracer.save()
     total_time = time.time() - start_time
     print('Finished! Total time:%.2fs' % total_time)
 
@@ -157,7 +201,7 @@ if __name__ == "__main__":
 
     model = tf.keras.models.load_model(model_path)
     w = direction.get_weights(model)
-    d = load_directions(dir_path)
+    d = load_directions(dir_path, weights=w)
 
     set_y = False
 
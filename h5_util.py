@@ -1,15 +1,128 @@
-import tensorflow as tf
+import h5py
 import numpy as np
+import tensorflow as tf
 
 def write_list(f, name, direction):
     grp = f.create_group(name)
     for i, l in enumerate(direction):
-        if isinstance(l, tf.Tensor):
-            l_np = l.numpy()
-        elif isinstance(l, np.ndarray):
-            l_np = np.copy(l)
-        grp.create_dataset(str(i), data=l_np)
+        write_item(grp, i, l)
+
+def write_item(grp, i, l):
+    if isinstance(l, tf.Tensor):
+        l_np = l.numpy()
+    else:
+        l_np = np.asarray(l)
+    grp.create_dataset(str(i), data=l_np)
+
+def write_flat(f, name, direction, dtype='float32', compression=None):
+    grp = create_flat(f, name, [np.shape(l) for l in direction], dtype=dtype, compression=compression)
+    for i, l in enumerate(direction):
+        write_flat_item(grp, i, l)
+
+def create_flat(f, name, shapes, dtype='float32', compression=None, chunk_size=2**18):
+    # Flat format: all tensors of a direction are raveled into the single dataset
+    # <name>/data, tensor i is data[offsets[i]:offsets[i+1]] with shape shapes[i]
+    # (padded with -1). Uncompressed data is stored contiguously and can be memory-mapped.
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    padded = -np.ones((len(shapes), max([1] + [len(shape) for shape in shapes])), dtype=np.int64)
+    for i, shape in enumerate(shapes):
+        padded[i, :len(shape)] = shape
+
+    grp = f.create_group(name)
+    grp.attrs['format'] = 'flat'
+    grp['offsets'] = offsets
+    grp['shapes'] = padded
+    if compression is None:
+        grp.create_dataset('data', shape=(offsets[-1],), dtype=dtype)
+    else:
+        grp.create_dataset('data', shape=(offsets[-1],), dtype=dtype, chunks=(min(chunk_size, max(1, offsets[-1])),), compression=compression, shuffle=True)
+    return grp
+
+def write_flat_item(grp, i, l):
+    offsets = grp['offsets']
+    l_np = l.numpy() if isinstance(l, tf.Tensor) else np.asarray(l)
+    grp['data'][offsets[i]:offsets[i+1]] = l_np.ravel().astype(grp['data'].dtype)
+
+def is_flat(f, name):
+    return f[name].attrs.get('format', None) == 'flat'
+
+def read_flat(f, name, mmap_path=None):
+    # Lazy list of the tensors of a flat direction. The data is read with one call,
+    # or memory-mapped if the path of the file is given.
+    grp = f[name]
+    offsets = grp['offsets'][:]
+    shapes = [tuple(s for s in shape if s >= 0) for shape in grp['shapes'][:]]
+    dset = grp['data']
+    if mmap_path is not None and dset.size > 0:
+        offset = dset.id.get_offset()
+        assert offset is not None, 'Dataset %s/data is chunked or compressed and can not be memory-mapped.' % (name)
+        data = np.memmap(mmap_path, mode='r', dtype=dset.dtype, shape=dset.shape, offset=offset)
+    else:
+        data = dset[:]
+    return Flat_List(data, offsets, shapes)
+
+
+class Flat_List(object):
+
+    def __init__(self, data, offsets, shapes):
+        self.data = data
+        self.offsets = offsets
+        self.shapes = shapes
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        # float32 data is returned as a view, float16 data is converted
+        return np.asarray(self.data[self.offsets[i]:self.offsets[i+1]], dtype=np.float32).reshape(self.shapes[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def write_seed(f, name, seed, axis=0, norm='filter', ignore='biasbn'):
+    # Direction stored as its seed only, see direction.creat_seed_direction
+    grp = f.create_group(name)
+    grp.attrs['rng'] = 'philox'
+    grp.attrs['seed'] = seed
+    grp.attrs['axis'] = axis
+    grp.attrs['norm'] = norm
+    grp.attrs['ignore'] = str(ignore)
+
+def read_seed(f, name):
+    attrs = f[name].attrs
+    if attrs.get('rng', None) != 'philox':
+        return None
+    ignore = None if attrs['ignore'] == 'None' else attrs['ignore']
+    return {'seed': int(attrs['seed']), 'axis': int(attrs['axis']), 'norm': attrs['norm'], 'ignore': ignore}
 
 def read_list(f, name):
+    if is_flat(f, name):
+        return read_flat(f, name)
     grp = f[name]
     return [grp[str(i)] for i in range(len(grp))] 
+
+def read_list_mmap(file_path, name):
+    f = h5py.File(file_path, 'r')
+    if is_flat(f, name):
+        views = read_flat(f, name, mmap_path=file_path)
+        f.close()
+        return views
+    grp = f[name]
+    views = []
+    for i in range(len(grp)):
+        dset = grp[str(i)]
+        offset = dset.id.get_offset()
+        if dset.size == 0:
+            views.append(np.zeros(dset.shape, dtype=dset.dtype))
+            continue
+        assert offset is not None, 'Dataset %s/%d is chunked or compressed and can not be memory-mapped.' % (name, i)
+        views.append(np.memmap(file_path, mode='r', dtype=dset.dtype, shape=dset.shape, offset=offset))
+    f.close()
+    return views
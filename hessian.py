@@ -0,0 +1,401 @@
+"""
+    Hessian of the training loss at the loaded weights.
+    Hessian-vector products are computed with tf.GradientTape double backprop,
+    batch by batch over a subset of the training set, so the Hessian is never
+    formed. The top-k eigenvectors (Lanczos or power iteration) can be written as
+    xdirection/ydirection and plotted like random directions.
+
+    The eigenvalue density (stochastic Lanczos quadrature) and the trace
+    (Hutchinson) of a checkpoint are estimated without computing a surface:
+        python hessian.py
+        mpiexec -n 4 python hessian.py
+    With MPI the probes are split across the processes (split='probe'), or the
+    data is sharded and every Hessian-vector product is summed over the
+    processes (split='data').
+"""
+
+import os
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+
+import argparse
+import math
+import time
+
+import h5py
+import numpy as np
+import tensorflow as tf
+
+import data_generator
+import data_loader
+import direction
+import h5_util
+
+try:
+    import mpi4tf as mpi
+except ImportError:
+    mpi = None #single process only
+
+
+def load_hessian_data(dataset, load_mode='tfds', pre_mode='norm', subset_size=5000, seed=0):
+    # preprocessed random subset of the training set, the rest is freed again
+    x_train, y_train, _, _ = data_loader.load_data(dataset, load_mode=load_mode)
+    x_mean, x_std = data_loader.get_stats(x_train, dataset, load_mode)
+
+    if subset_size is not None and subset_size < len(x_train):
+        idx = np.sort(np.random.RandomState(seed).choice(len(x_train), subset_size, replace=False))
+        x_train, y_train = x_train[idx], y_train[idx]
+    x_set = data_generator.preprocess_input(x_train, x_mean, x_std, mode=pre_mode)
+    return x_set, y_train
+
+
+class Hessian_Operator(object):
+    # H v of the loss (sum of the batch losses / number of samples + regularization)
+    # with respect to the trainable weights, vectors are flat float32 numpy arrays.
+
+    # comm: x_set/y_set are the data shard of this process, H v is summed over the processes
+
+    def __init__(self, model, model_type, x_set, y_set, batch_size=128, add_reg=True, ignore=None, comm=None):
+        self.model = model
+        self.model_type = model_type
+        self.x_set = x_set
+        self.y_set = y_set
+        self.batch_size = batch_size
+        self.add_reg = add_reg and ('qn' not in model_type)
+        self.params = model.trainable_weights
+        self.shapes = [p.shape for p in self.params]
+        self.sizes = [int(np.prod(s)) for s in self.shapes]
+        self.dim = int(sum(self.sizes))
+        self.num_hvp = 0
+        self.comm = comm
+        self.rank = 0 if comm is None else mpi.get_rank(comm)
+        self.total = len(x_set) if comm is None else int(mpi.allreduce_sum(comm, np.array([len(x_set)]))[0])
+
+        # ignore='biasbn': the operator is restricted to the multi-dimensional weights,
+        # the same subspace that the random directions span.
+        self.mask = None
+        if ignore == 'biasbn':
+            self.mask = np.concatenate([np.full(size, len(shape) > 1, dtype=np.float32) for size, shape in zip(self.sizes, self.shapes)])
+
+        from_logits = 'qn' in model_type
+        self.cce = tf.keras.losses.CategoricalCrossentropy(reduction=tf.keras.losses.Reduction.SUM, from_logits=from_logits)
+        self._batch_hvp = tf.function(self._hvp)
+
+    def _hvp(self, x, y, v, scale, add_reg):
+        with tf.GradientTape() as outer_tape:
+            with tf.GradientTape() as inner_tape:
+                out = self.model(x, training=False)
+                loss = self.cce(y, out) * scale
+                if add_reg:
+                    loss += tf.add_n(self.model.losses)
+            grads = inner_tape.gradient(loss, self.params)
+            gv = tf.add_n([tf.reduce_sum(g * vi) for g, vi in zip(grads, v)])
+        return outer_tape.gradient(gv, self.params)
+
+    def split(self, vec):
+        vs, start = [], 0
+        for size, shape in zip(self.sizes, self.shapes):
+            vs.append(tf.convert_to_tensor(vec[start:start+size].reshape(shape), dtype=tf.float32))
+            start += size
+        return vs
+
+    def matvec(self, vec):
+        if self.mask is not None:
+            vec = vec * self.mask
+        v = self.split(vec)
+        scale = tf.constant(1. / self.total, dtype=tf.float32)
+        hv = np.zeros(self.dim, dtype=np.float32)
+        for idx in range(math.ceil(len(self.x_set) / self.batch_size)):
+            x = self.x_set[self.batch_size*idx:self.batch_size*(idx+1)]
+            y = self.y_set[self.batch_size*idx:self.batch_size*(idx+1)]
+            add_reg = self.add_reg and idx == 0 and self.rank == 0 and len(self.model.losses) > 0 #weight decay counted once
+            batch_hv = self._batch_hvp(x, y, v, scale, add_reg)
+            hv += np.concatenate([np.zeros(size, dtype=np.float32) if g is None else g.numpy().ravel()
+                                  for g, size in zip(batch_hv, self.sizes)])
+        if self.comm is not None:
+            hv = mpi.allreduce_sum(self.comm, hv)
+        self.num_hvp += 1
+        if self.mask is not None:
+            hv *= self.mask
+        return hv
+
+    def to_direction(self, vec):
+        # flat vector over the trainable weights -> list over model.weights, non-trainable weights are zero
+        trainable = {id(p): v for p, v in zip(self.params, self.split(vec))}
+        return [trainable.get(id(p), tf.zeros(p.shape, dtype=tf.float32)) for p in self.model.weights]
+
+
+def lanczos(matvec, v0, num_iter):
+    # Lanczos with full reorthogonalization, returns the tridiagonal (alphas, betas)
+    # and the Lanczos vectors.
+    dim = len(v0)
+    num_iter = min(num_iter, dim)
+    basis = np.zeros((num_iter, dim), dtype=np.float32)
+    alphas = np.zeros(num_iter)
+    betas = np.zeros(max(num_iter - 1, 0))
+
+    v = v0 / np.linalg.norm(v0)
+    for i in range(num_iter):
+        basis[i] = v
+        w = matvec(v).astype(np.float64)
+        alphas[i] = np.dot(w, v)
+        w -= np.dot(basis[:i+1].T, np.dot(basis[:i+1], w)) #twice is enough
+        w -= np.dot(basis[:i+1].T, np.dot(basis[:i+1], w))
+        if i == num_iter - 1:
+            break
+        betas[i] = np.linalg.norm(w)
+        if betas[i] < 1e-10: #invariant subspace found
+            return alphas[:i+1], betas[:i], basis[:i+1]
+        v = (w / betas[i]).astype(np.float32)
+
+    return alphas, betas, basis
+
+def tridiag_eigh(alphas, betas):
+    T = np.diag(alphas) + np.diag(betas, 1) + np.diag(betas, -1)
+    return np.linalg.eigh(T)
+
+def lanczos_top_eigen(matvec, dim, k=2, num_iter=20, seed=0):
+    v0 = np.random.RandomState(seed).randn(dim).astype(np.float32)
+    alphas, betas, basis = lanczos(matvec, v0, num_iter)
+    evals, evecs = tridiag_eigh(alphas, betas)
+    order = np.argsort(evals)[::-1][:k]
+    eigenvectors = np.dot(evecs[:, order].T, basis).astype(np.float32)
+    eigenvectors /= np.linalg.norm(eigenvectors, axis=1, keepdims=True)
+    return evals[order], eigenvectors
+
+def power_iteration(matvec, v, deflate, num_iter, tol, shift=0.):
+    # power iteration on H - shift * I, stops when the residual ||H v - lambda v|| / |lambda|
+    # is below tol. Returns the Rayleigh quotient of H and the unit vector.
+    eigenvalue = 0.
+    for _ in range(num_iter):
+        v = deflate(v)
+        v /= np.linalg.norm(v)
+        hv = deflate(matvec(v))
+        eigenvalue = float(np.dot(v, hv))
+        residual = np.linalg.norm(hv - eigenvalue * v) / (abs(eigenvalue) + 1e-12)
+        if residual <= tol:
+            break
+        v = hv - shift * v
+    else:
+        print('Power iteration not converged after %d steps, residual %.2e' % (num_iter, residual))
+    return eigenvalue, v
+
+def power_top_eigen(matvec, dim, k=2, num_iter=100, tol=1e-3, seed=0):
+    # Power iteration with deflation against the eigenvectors that are found already.
+    # Power iteration finds the largest |lambda|, if that is negative the iteration is
+    # repeated on H - lambda I, whose dominant eigenvalue is the largest lambda of H.
+    # num_iter: maximum number of Hessian-vector products per eigenvalue and run
+    rs = np.random.RandomState(seed)
+    eigenvalues, eigenvectors = [], []
+    for _ in range(k):
+        def deflate(v):
+            for u in eigenvectors:
+                v = v - np.dot(u, v) * u
+            return v
+        v0 = rs.randn(dim).astype(np.float32)
+        eigenvalue, v = power_iteration(matvec, v0, deflate, num_iter, tol)
+        if eigenvalue < 0:
+            eigenvalue, v = power_iteration(matvec, v0, deflate, num_iter, tol, shift=eigenvalue)
+        v = deflate(v)
+        eigenvalues.append(eigenvalue)
+        eigenvectors.append((v / np.linalg.norm(v)).astype(np.float32))
+    return np.array(eigenvalues), np.array(eigenvectors)
+
+def top_eigen(operator, k=2, method='lanczos', num_iter=None, seed=0):
+    # num_iter: Lanczos steps, or maximum power iterations per eigenvalue, None for the defaults
+    start = time.time()
+    if method == 'lanczos':
+        num_iter = 20 if num_iter is None else num_iter
+        eigenvalues, eigenvectors = lanczos_top_eigen(operator.matvec, operator.dim, k=k, num_iter=num_iter, seed=seed)
+    elif method == 'power':
+        num_iter = 100 if num_iter is None else num_iter
+        eigenvalues, eigenvectors = power_top_eigen(operator.matvec, operator.dim, k=k, num_iter=num_iter, seed=seed)
+    else:
+        raise Exception('Unknown eigen method: %s' % method)
+    print('Top %d Hessian eigenvalues: %s (%d hvp, %.2fs)' % (k, str(eigenvalues), operator.num_hvp, time.time() - start))
+    return eigenvalues, eigenvectors
+
+def write_hessian_direction(f, model, model_type, x_set, y_set, set_y=True, batch_size=128, add_reg=True,
+                            method='lanczos', num_iter=None, ignore=None, seed=0, norm='filter'):
+    # Top Hessian eigenvectors as xdirection (and ydirection).
+    # norm: 'filter', 'layer' or 'model' scales the multi-dimensional weights of the
+    #       eigenvectors as the random directions (direction.normalize_direction), so that
+    #       l_range has the same meaning for both. None keeps the unit-norm eigenvectors,
+    #       then l_range is a distance in weight space.
+    operator = Hessian_Operator(model, model_type, x_set, y_set, batch_size=batch_size, add_reg=add_reg, ignore=ignore)
+    names = ['xdirection', 'ydirection'] if set_y else ['xdirection']
+    eigenvalues, eigenvectors = top_eigen(operator, k=len(names), method=method, num_iter=num_iter, seed=seed)
+
+    weights = direction.get_weights(model)
+    for name, eigenvector in zip(names, eigenvectors):
+        d = operator.to_direction(eigenvector)
+        if norm is not None:
+            # the 1D weights keep their eigenvector components (zero with ignore='biasbn')
+            d_norm = direction.normalize_directions_for_weights(d, weights, norm=norm, ignore='biasbn')
+            d = [n if len(n.shape) > 1 else e for n, e in zip(d_norm, d)]
+        h5_util.write_list(f, name, d)
+    f.attrs['eigenvalues'] = eigenvalues
+    f.attrs['method'] = method
+    f.attrs['norm'] = str(norm)
+    f.attrs['num_samples'] = len(x_set)
+    f.flush()
+    return eigenvalues
+
+def rademacher(dim, seed, probe_id):
+    return np.random.RandomState([seed, probe_id]).choice([-1., 1.], size=dim).astype(np.float32)
+
+def slq(operator, probe_ids, num_iter=30, seed=0):
+    # Stochastic Lanczos quadrature: the Ritz values (nodes) of each probe and the
+    # squared first components of their eigenvectors (weights), see Ghorbani et al. 2019.
+    nodes, weights = [], []
+    for probe_id in probe_ids:
+        alphas, betas, _ = lanczos(operator.matvec, rademacher(operator.dim, seed, probe_id), num_iter)
+        evals, evecs = tridiag_eigh(alphas, betas)
+        node, weight = np.full(num_iter, evals[-1]), np.zeros(num_iter) #padded with zero weight if lanczos stopped early
+        node[:len(evals)] = evals
+        weight[:len(evals)] = np.square(evecs[0])
+        nodes.append(node)
+        weights.append(weight)
+    return np.array(nodes).reshape(-1, num_iter), np.array(weights).reshape(-1, num_iter)
+
+def hutchinson_trace(operator, probe_ids, seed=0):
+    # tr(H) = E[v^T H v] for Rademacher v, one sample per probe
+    samples = []
+    for probe_id in probe_ids:
+        v = rademacher(operator.dim, seed + 1, probe_id) #other probes than slq
+        samples.append(float(np.dot(v, operator.matvec(v))))
+    return np.array(samples)
+
+def spectral_density(nodes, weights, num_bins=1000, sigma_ratio=1e-2):
+    # Gaussian smoothed density of the quadrature, averaged over the probes
+    lambda_min, lambda_max = np.min(nodes), np.max(nodes)
+    margin = 0.05 * (lambda_max - lambda_min + 1e-12)
+    grid = np.linspace(lambda_min - margin, lambda_max + margin, num=num_bins)
+    sigma = sigma_ratio * max(lambda_max - lambda_min, 1e-12)
+
+    density = np.zeros(num_bins)
+    for node, weight in zip(nodes, weights):
+        diff = grid[:, None] - node[None, :]
+        density += np.sum(weight[None, :] * np.exp(-np.square(diff) / (2 * sigma**2)), axis=1) / np.sqrt(2 * np.pi * sigma**2)
+    density /= len(nodes)
+    return grid, density
+
+def eval_spectrum(model, model_type, x_set, y_set, out_path=None, batch_size=128, add_reg=True, num_probes=4, num_iter=30,
+                  num_trace_probes=16, seed=0, comm=None, split='probe'):
+    # Hessian eigenvalue density and trace of the loaded weights, written to out_path by rank 0.
+    # split='probe': every process evaluates all of x_set for its share of the probes
+    # split='data': every process holds a shard of x_set, all processes run all probes
+    rank = 0 if comm is None else mpi.get_rank(comm)
+    nproc = 1 if comm is None else mpi.get_num_procs(comm)
+    start = time.time()
+
+    if split == 'data':
+        operator = Hessian_Operator(model, model_type, x_set[rank::nproc], y_set[rank::nproc], batch_size=batch_size, add_reg=add_reg, comm=comm)
+        slq_ids, trace_ids = range(num_probes), range(num_trace_probes)
+    elif split == 'probe':
+        operator = Hessian_Operator(model, model_type, x_set, y_set, batch_size=batch_size, add_reg=add_reg)
+        slq_ids, trace_ids = range(rank, num_probes, nproc), range(rank, num_trace_probes, nproc)
+    else:
+        raise Exception('Unknown split: %s' % split)
+
+    nodes, weights = slq(operator, slq_ids, num_iter=num_iter, seed=seed)
+    trace_samples = hutchinson_trace(operator, trace_ids, seed=seed)
+
+    if split == 'probe' and comm is not None:
+        gathered = mpi.gather(comm, (nodes, weights, trace_samples))
+        if rank == 0:
+            nodes = np.concatenate([g[0] for g in gathered])
+            weights = np.concatenate([g[1] for g in gathered])
+            trace_samples = np.concatenate([g[2] for g in gathered])
+    if rank != 0:
+        return None
+
+    grid, density = spectral_density(nodes, weights)
+    result = {
+        'trace': float(np.mean(trace_samples)),
+        'trace_std': float(np.std(trace_samples) / np.sqrt(len(trace_samples))),
+        'lambda_max': float(np.max(nodes)),
+        'lambda_min': float(np.min(nodes)),
+        'time': time.time() - start,
+    }
+    print('Hessian trace: %.4f (+-%.4f), lambda_max: %.4f, lambda_min: %.4f, %d hvp/proc, %.2fs' %
+          (result['trace'], result['trace_std'], result['lambda_max'], result['lambda_min'], operator.num_hvp, result['time']))
+
+    if out_path is not None:
+        f = h5py.File(out_path, 'w')
+        f['nodes'] = nodes
+        f['weights'] = weights
+        f['trace_samples'] = trace_samples
+        f['density_grid'] = grid
+        f['density'] = density
+        for k, v in result.items():
+            f.attrs[k] = v
+        f.attrs['num_samples'] = len(x_set)
+        f.attrs['num_iter'] = num_iter
+        f.attrs['split'] = split
+        f.attrs['nproc'] = nproc
+        f.close()
+        print('Spectrum saved: %s' % out_path)
+
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Hessian eigenvalue density and trace of checkpoints')
+    parser.add_argument('--subset_size', default=5000, type=int, help='Number of training samples')
+    parser.add_argument('--batch_size', default=128, type=int)
+    parser.add_argument('--num_probes', default=4, type=int, help='Number of SLQ probes')
+    parser.add_argument('--num_iter', default=30, type=int, help='Lanczos steps per SLQ probe')
+    parser.add_argument('--num_trace_probes', default=16, type=int, help='Number of Hutchinson probes')
+    parser.add_argument('--split', default='probe', help='probe | data, how the work is split across MPI processes')
+    parser.add_argument('--mpi', action='store_true', help='Use MPI')
+    args = parser.parse_args()
+
+    gpus = tf.config.experimental.list_physical_devices('GPU') #should limit gpu memory growth while using cuda & mpi.
+    for gpu in gpus:
+        tf.config.experimental.set_memory_growth(gpu, True)
+
+    from build_model import build_model
+
+    comm = mpi.setup_MPI() if args.mpi else None
+    rank = 0 if comm is None else mpi.get_rank(comm)
+
+    model_type_list = ['vgg9_bn']
+    dataset = 'cifar10'
+    load_mode = 'tfds'
+    fc_type = 'avg'
+    l2_reg_rate = 5e-4
+    run_dict = {
+        "vgg9_bn": [
+            {
+                "model_path": "D:/Rain/text/Python/MA_IIIT/models/vgg9/vgg9_bn_128_norm_SGDNesterov_l2=0.0005_avg_cifar10_243_0.9123_weights.h5",
+                "pre_mode": "norm",
+            },
+            {
+                "model_path": "D:/Rain/text/Python/MA_IIIT/models/vgg9/vgg9_bn_128_norm_SGDNesterov_l2=0.0005_avg_cifar_base_180_0.9472_weights.h5",
+                "pre_mode": "norm",
+            },
+            {
+                "model_path": "D:/Rain/text/Python/MA_IIIT/models/vgg9/vgg9_bn_128_norm_SGDNesterov_l2=0.0005_avg_cifar_auto_246_0.9526_weights.h5",
+                "pre_mode": "norm",
+            },
+        ],
+    }
+
+    results = {}
+    for model_type in model_type_list:
+        for run in run_dict[model_type]:
+            model_path = run["model_path"]
+            model = build_model(model_type, dataset, fc_type=fc_type, l2_reg_rate=l2_reg_rate).model
+            model.load_weights(model_path)
+            x_set, y_set = load_hessian_data(dataset, load_mode=load_mode, pre_mode=run["pre_mode"], subset_size=args.subset_size)
+
+            results[model_path] = eval_spectrum(model, model_type, x_set, y_set, out_path=model_path[:-3] + '_spectrum.h5',
+                                                batch_size=args.batch_size, num_probes=args.num_probes, num_iter=args.num_iter,
+                                                num_trace_probes=args.num_trace_probes, comm=comm, split=args.split)
+            tf.keras.backend.clear_session()
+
+    if rank == 0:
+        print('------------------------------------------------------------------')
+        for model_path, result in results.items():
+            print('%s:\ttrace: %.4f,\tlambda_max: %.4f' % (os.path.basename(model_path), result['trace'], result['lambda_max']))
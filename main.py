@@ -3,18 +3,20 @@ import os
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
 import h5py
-import numpy as np
 import tensorflow as tf
 from tensorflow.keras.models import load_model
 
 import data_generator
 import data_loader
 import direction
+import direction_store
 import evaluation
 import h5_util
+import hessian
 import plot_1D
 import plot_2D
 from build_model import build_model
+from tracer import Stage_Tracer
 from quantization.build_vgg_qn import CUSTOM_OBJ
 
 
@@ -28,15 +30,34 @@ def main(model_type,
          pre_mode   = 'norm',
          add_aug    = False, 
          aug_pol    = 'cifar_auto', 
+         aug_seed   = None,
+         aug_workers= None,
          l2_reg_rate= None, 
          fc_type    = None,
          dir_path   = None, 
+         dir_norm   = 'filter',
+         dir_seed   = None,
+         dir_regen  = False,
+         dir_format = 'list',
+         dir_dtype  = 'float32',
+         dir_compression = None,
+         dir_type   = 'random',
+         checkpoints= None,
+         hess_subset= 5000,
          fig_type   = '1D', 
          dot_num    = 11,
          l_range    = (-1, 1),
          loss_key   = 'train_loss',
          add_reg    = True,
+         trace_dir  = None,
+         trace_points = None,
         ):
+    # trace_dir: write stage timings/memory and a tf.profiler trace to this directory
+    # trace_points: (start, stop) grid point indices of the tf.profiler trace window
+    # aug_seed, aug_workers: seed and number of processes of the augmented train set (add_aug),
+    #                        with a seed the set stays in the augmentation cache for later runs
+
+    tracer = Stage_Tracer(trace_dir, trace_points)
 
     try:
         model = load_model(model_path, custom_objects=CUSTOM_OBJ)
@@ -44,8 +65,32 @@ def main(model_type,
         model = build_model(model_type, dataset, fc_type=fc_type, l2_reg_rate=l2_reg_rate, L_A=L_A, L_W=L_W).model
         model.load_weights(model_path)
     
-    if dir_path == None: 
-        dir_path = model_path[:-3] + '_' + fig_type + '_' + str(l_range[0]) + '_' + str(l_range[1]) + '.h5'
+    # dir_seed: seed of the random directions
+    # dir_regen: store only the seed in the direction file and regenerate the directions from it
+    # dir_format: 'list' (one dataset per tensor) or 'flat' (one contiguous dataset, see h5_util.create_flat)
+    # dir_dtype, dir_compression: storage dtype ('float32'/'float16') and h5py compression of the flat format
+    # dir_type: 'random', 'pca' (PCA of the training trajectory, see direction.write_pca_direction)
+    #           or 'hessian' (top Hessian eigenvectors of the training loss, see hessian.write_hessian_direction)
+    # checkpoints: glob pattern of the ModelCheckpoint files of the trajectory for dir_type='pca'
+    # hess_subset: number of training samples of the Hessian-vector products for dir_type='hessian'
+    assert not dir_regen or dir_seed is not None, 'dir_regen needs a dir_seed.'
+    assert dir_type != 'pca' or checkpoints is not None, "dir_type='pca' needs the checkpoints."
+
+    if dir_path == None and dir_type in ['pca', 'hessian']:
+        dir_path = model_path[:-3] + '_' + fig_type + '_' + str(l_range[0]) + '_' + str(l_range[1]) + '_' + dir_type + '.h5'
+        surf_prefix = dir_path[:-3]
+    elif dir_path == None and dir_seed is not None and not dir_regen:
+        # directions from the content-addressed store, only created once per model/seed/norm
+        with tracer.stage('direction'):
+            dir_path = direction_store.get_direction(model, dir_seed, set_y=(fig_type == '2D'), norm=dir_norm,
+                                                     flat=(dir_format == 'flat'), dtype=dir_dtype, compression=dir_compression)
+        surf_prefix = model_path[:-3] + '_' + fig_type + '_' + str(l_range[0]) + '_' + str(l_range[1]) + '_seed=' + str(dir_seed)
+    else:
+        if dir_path == None and dir_regen:
+            dir_path = model_path[:-3] + '_' + fig_type + '_' + str(l_range[0]) + '_' + str(l_range[1]) + '_seed=' + str(dir_seed) + '_' + dir_norm + '.h5'
+        elif dir_path == None: 
+            dir_path = model_path[:-3] + '_' + fig_type + '_' + str(l_range[0]) + '_' + str(l_range[1]) + '.h5'
+        surf_prefix = dir_path[:-3]
     
     if os.path.exists(dir_path):
         print("Direction file is already created.")
@@ -60,60 +105,73 @@ def main(model_type,
 
         f.close()
     else:
-        f = h5py.File(dir_path, 'w')
-
-        xdirection = direction.creat_random_direction(model)
-        h5_util.write_list(f, 'xdirection', xdirection)
-
-        if fig_type == '2D':
-            ydirection = direction.creat_random_direction(model)
-            h5_util.write_list(f, 'ydirection', ydirection)
-            set_y = True
-        else:
-            set_y = False
-        
-        f.close()
+        with tracer.stage('direction'):
+            f = h5py.File(dir_path, 'w')
+            set_y = fig_type == '2D'
+
+            if dir_type == 'pca':
+                checkpoint_paths = direction.get_checkpoint_paths(checkpoints)
+                direction.write_pca_direction(f, model, checkpoint_paths, proj_path=dir_path[:-3] + '_proj.h5',
+                                              n_components=2 if set_y else 1)
+            elif dir_type == 'hessian':
+                x_hess, y_hess = hessian.load_hessian_data(dataset, load_mode=load_mode, pre_mode=pre_mode, subset_size=hess_subset)
+                hessian.write_hessian_direction(f, model, model_type, x_hess, y_hess, set_y=set_y, batch_size=batch_size, add_reg=add_reg,
+                                                norm=dir_norm)
+                del x_hess, y_hess
+            elif dir_regen:
+                h5_util.write_seed(f, 'xdirection', dir_seed, axis=0, norm=dir_norm)
+                if set_y:
+                    h5_util.write_seed(f, 'ydirection', dir_seed, axis=1, norm=dir_norm)
+            else:
+                flat = dir_format == 'flat'
+                direction.write_random_direction(f, 'xdirection', model, seed=dir_seed, axis=0, norm=dir_norm, flat=flat, dtype=dir_dtype, compression=dir_compression)
+
+                if set_y:
+                    direction.write_random_direction(f, 'ydirection', model, seed=dir_seed, axis=1, norm=dir_norm, flat=flat, dtype=dir_dtype, compression=dir_compression)
+            
+            f.close()
         print("Direction file created.")
 
     if 'qn' not in model_type:
-        surf_path = dir_path[:-3] + '_surface' + '_' + str(dot_num) + '_' + loss_key + '_add_reg=' + str(add_reg) +'.h5'
+        surf_path = surf_prefix + '_surface' + '_' + str(dot_num) + '_' + loss_key + '_add_reg=' + str(add_reg) +'.h5'
     else:
-        surf_path = dir_path[:-3] + '_surface' + '_' + str(dot_num) + '_' + loss_key +'.h5'
+        surf_path = surf_prefix + '_surface' + '_' + str(dot_num) + '_' + loss_key +'.h5'
 
     w = direction.get_weights(model)
-    d = evaluation.load_directions(dir_path)
+    with tracer.stage('load_direction'):
+        d = evaluation.load_directions(dir_path, weights=w)
+        d = d if set_y else d[:1] #a stored file may hold a y direction for 2D plots as well
 
     evaluation.setup_surface_file(surf_path, dir_path, set_y, num=dot_num, l_range=l_range)
 
-    if loss_key == 'train_loss':
-        acc_key = 'train_acc'
-        if not add_aug:
-            x_set, y_set, _, _ = data_loader.load_data(dataset, load_mode=load_mode)
-            x_mean = np.mean(x_set).astype('float32')
-            x_std = np.std(x_set).astype('float32')
+    with tracer.stage('data'):
+        if loss_key == 'train_loss':
+            acc_key = 'train_acc'
+            if not add_aug:
+                x_set, y_set, _, _ = data_loader.load_data(dataset, load_mode=load_mode)
+                x_mean, x_std = data_loader.get_stats(x_set, dataset, load_mode)
+                #x_set = (x_set.astype('float32') - x_mean) / (x_std + 1e-7)
+                x_set = data_generator.preprocess_input(x_set, x_mean, x_std, mode=pre_mode)
+            else:
+                print("Load temp dataset.")
+                temp_file_path = data_generator.set_temp_dataset(dataset, load_mode, aug_pol, seed=aug_seed, num_workers=aug_workers)
+                x_set, y_set = data_generator.load_temp_dataset(temp_file_path, pre_mode=pre_mode)
+                print("Temp dataset loaded.")
+                if aug_seed is None: #a random seed is never requested again
+                    data_generator.remove_temp_dataset(temp_file_path)
+
+        elif loss_key == 'test_loss':
+            acc_key = 'test_acc'
+            x_train, _, x_set, y_set= data_loader.load_data(dataset, load_mode=load_mode)
+            x_mean, x_std = data_loader.get_stats(x_train, dataset, load_mode)
             #x_set = (x_set.astype('float32') - x_mean) / (x_std + 1e-7)
             x_set = data_generator.preprocess_input(x_set, x_mean, x_std, mode=pre_mode)
-        else:
-            print("Load temp dataset.")
-            temp_file_path = data_generator.set_temp_dataset(dataset, load_mode, aug_pol, pre_mode=pre_mode)
-            x_set, y_set = data_generator.load_temp_dataset(temp_file_path)
-            print("Temp dataset loaded.")
-            #if os.path.exists(temp_file_path):
-            #    os.remove(temp_file_path)
-            data_generator.remove_temp_dataset(temp_file_path)
-
-    elif loss_key == 'test_loss':
-        acc_key = 'test_acc'
-        x_train, _, x_set, y_set= data_loader.load_data(dataset, load_mode=load_mode)
-        x_mean = np.mean(x_train).astype('float32')
-        x_std = np.std(x_train).astype('float32')
-        #x_set = (x_set.astype('float32') - x_mean) / (x_std + 1e-7)
-        x_set = data_generator.preprocess_input(x_set, x_mean, x_std, mode=pre_mode)
 
-    else:
-        raise Exception("Unknown loss key: %s" % (loss_key))
+        else:
+            raise Exception("Unknown loss key: %s" % (loss_key))
 
-    evaluation.crunch(surf_path, model, model_type, w, d, x_set, y_set, loss_key, acc_key, batch_size=batch_size, add_reg=add_reg, L_A=L_A, L_W=L_W)
+    evaluation.crunch(surf_path, model, model_type, w, d, x_set, y_set, loss_key, acc_key, batch_size=batch_size, add_reg=add_reg, L_A=L_A, L_W=L_W, tracer=tracer)
+    tracer.save()
     '''
     if fig_type == '1D':
         plot_1D.plot_1d_loss_err(surf_path, xmin=l_range[0], xmax=l_range[1], loss_max=5, log=False, show=False)
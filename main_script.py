@@ -2,14 +2,11 @@ import os
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
-import h5py
 import numpy as np
 import tensorflow as tf
 
-import direction
+import data_loader
 import evaluation
-import h5_util
-from build_model import build_model
 from main import main
 from quantization.build_vgg_qn import CUSTOM_OBJ
 
@@ -30,6 +27,7 @@ if __name__ == "__main__":
     dataset = 'cifar10'
     fc_type = 'avg'
     load_mode = 'tfrd'
+    data_loader.use_cache = True #decode the dataset once for all runs
     #pre_mode = 'norm'
     #pre_mode = 'scale'
     #l2_reg_rate = 1e-5 if 'qn' in model_type else 5e-4
@@ -79,13 +77,10 @@ if __name__ == "__main__":
     loss_key_list = ['train_loss']
     add_reg = False
     
+    dir_seed = 123 #the same random directions for all runs of a model type
+    
     for model_type in model_type_list:
         l2_reg_rate = 1e-5 if 'qn' in model_type else 5e-4
-        model = build_model(model_type, dataset, fc_type=fc_type, l2_reg_rate=l2_reg_rate, L_A=L_A, L_W=L_W).model
-    
-        w = direction.get_weights(model)
-        dx = direction.get_random_weights(w)
-        dy = direction.get_random_weights(w)
 
         run_list = run_dict[model_type]
         for run in run_list:
@@ -93,17 +88,6 @@ if __name__ == "__main__":
             add_aug = run["add_aug"]
             aug_pol = run["aug_pol"]
 
-            model.load_weights(model_path)
-            w = direction.get_weights(model)
-            norm_dx = direction.normalize_directions_for_weights(dx, w)
-            norm_dy = direction.normalize_directions_for_weights(dy, w)
-
-            dir_path = model_path[:-3] + '_' + fig_type + '_' + str(l_range[0]) + '_' + str(l_range[1]) + '_same.h5'
-            f = h5py.File(dir_path, 'w')
-            h5_util.write_list(f, 'xdirection', norm_dx)
-            h5_util.write_list(f, 'ydirection', norm_dy)
-            f.close()
-
             if 'norm' in model_path:
                 pre_mode = 'norm'
             elif 'scale' in model_path:
@@ -114,4 +98,4 @@ if __name__ == "__main__":
             for loss_key, dot_num in zip(loss_key_list, dot_num_list):
                 main(model_type, model_path, batch_size=batch_size, dataset=dataset, load_mode=load_mode, L_A=L_A, L_W=L_W,
                     pre_mode=pre_mode, add_aug=add_aug, aug_pol=aug_pol, l2_reg_rate=l2_reg_rate, fc_type=fc_type,
-                    dir_path=dir_path, fig_type=fig_type, dot_num=dot_num, l_range=l_range, loss_key=loss_key, add_reg=add_reg)
+                    dir_seed=dir_seed, fig_type=fig_type, dot_num=dot_num, l_range=l_range, loss_key=loss_key, add_reg=add_reg)
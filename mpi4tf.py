@@ -98,6 +98,19 @@ def reduce_min(comm, array, display_info=False):
     comm.Reduce(array, total, op=mpi4py.MPI.MIN, root=0)
     return total
 
+def allreduce_sum(comm, array):
+    if not comm:
+        return array
+    array = np.asarray(array, dtype=np.float32)
+    total = np.zeros_like(array)
+    comm.Allreduce(array, total, op=mpi4py.MPI.SUM)
+    return total
+
+def gather(comm, obj):
+    if not comm:
+        return [obj]
+    return comm.gather(obj, root=0)
+
 def barrier(comm):
     if not comm:
         return
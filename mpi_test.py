@@ -15,6 +15,7 @@ import data_loader
 import direction
 import evaluation
 import h5_util
+import crunch_stats
 import mpi4tf as mpi
 import plot_1D
 import plot_2D
@@ -47,13 +48,13 @@ if __name__ == "__main__":
     model = build_model('resnet56', dataset, fc_type='avg', l2_reg_rate=5e-4).model
     model.load_weights(model_path)
     w = direction.get_weights(model)
-    d = evaluation.load_directions(dir_path)    
+    d = evaluation.load_directions(dir_path, weights=w)    
 
     if rank == 0:
         evaluation.setup_surface_file(surf_path, dir_path, set_y, num=dot_num, l_range=(-0.2, 0.2))
         print("Loading temp dataset.")
         sys.stdout.flush()
-        temp_file_path = data_generator.set_temp_dataset(dataset, load_mode, aug_pol, pre_mode='norm')
+        temp_file_path = data_generator.set_temp_dataset(dataset, load_mode, aug_pol, seed=123)
         begin_time = time.time()
     else:
         temp_file_path = ''
@@ -62,7 +63,7 @@ if __name__ == "__main__":
 
     temp_file_path = comm.bcast(temp_file_path, root=0)
 
-    x_train, y_train = data_generator.load_temp_dataset(temp_file_path)
+    x_train, y_train = data_generator.load_temp_dataset(temp_file_path, pre_mode='norm')
     print('Rank:%d loaded temp dataset' % (rank))
     sys.stdout.flush()
     
@@ -102,6 +103,11 @@ if __name__ == "__main__":
         losses = f[loss_key][:]
         accuracies = f[acc_key][:]
 
+    if rank == 0:
+        metrics = crunch_stats.setup_metrics(f, loss_key, losses.shape, batch_size=batch_size, num_samples=len(x_train), model_type='resnet56', nproc=nproc, start_time=time.time())
+    else:
+        metrics = {key: -np.ones(shape=losses.shape) for key in crunch_stats.METRIC_KEYS}
+
     inds, coords, inds_nums = scheduler.get_job_indices(losses, xcoordinates, ycoordinates, comm)
     print('Computing %d values for rank %d'% (len(inds), rank))
     sys.stdout.flush()
@@ -112,26 +118,37 @@ if __name__ == "__main__":
 
     for count, ind in enumerate(inds):
         coord = coords[count]
+        point_start = time.time()
         evaluation.set_weights(model, w, d, coord)
+        assign_time = time.time() - point_start
 
         print('Rank:%d computing' % (rank))
         loss_start = time.time()
-        loss, acc = evaluation.eval_loss(model, cce, x_train, y_train, batch_size)
+        stats = {}
+        loss, acc = evaluation.eval_loss(model, 'resnet56', cce, x_train, y_train, batch_size, stats=stats)
         loss_compute_time = time.time() - loss_start
     
         losses.ravel()[ind] = loss
         accuracies.ravel()[ind] = acc
+        metrics['assign_time'].ravel()[ind] = assign_time
+        metrics['data_time'].ravel()[ind] = stats['data_time']
+        metrics['ips'].ravel()[ind] = len(x_train) / stats['eval_time']
+        metrics['time'].ravel()[ind] = time.time() - point_start
 
         syc_start = time.time()
         losses = mpi.reduce_max(comm, losses)
         accuracies = mpi.reduce_max(comm, accuracies)
+        metrics = {key: mpi.reduce_max(comm, metrics[key]) for key in crunch_stats.METRIC_KEYS}
 
         syc_time = time.time() - syc_start
         total_sync += syc_time
+        #sync time of this point is gathered with the next reduction
+        metrics['sync_time'].ravel()[ind] = syc_time
 
         if rank == 0:
             f[loss_key][:] = losses
             f[acc_key][:] = accuracies
+            crunch_stats.write_metrics(f, loss_key, metrics)
             f.flush()
 
         print('Evaluating rank %d  %d/%d  (%.1f%%)  coord=%s \t%s= %.3f \t%s=%.2f \ttime=%.2f \tsync=%.2f' % (
@@ -142,6 +159,12 @@ if __name__ == "__main__":
     for i in range(max(inds_nums) - len(inds)):
         losses = mpi.reduce_max(comm, losses)
         accuracies = mpi.reduce_max(comm, accuracies)    
+        metrics = {key: mpi.reduce_max(comm, metrics[key]) for key in crunch_stats.METRIC_KEYS}
+
+    metrics['sync_time'] = mpi.reduce_max(comm, metrics['sync_time'])
+    if rank == 0:
+        crunch_stats.write_metrics(f, loss_key, metrics)
+        f.flush()
 
     total_time = time.time() - start_time
     print('Rank %d done! Total time: %.2f Sync: %.2f' % (rank, total_time, total_sync))
@@ -151,7 +174,6 @@ if __name__ == "__main__":
     
     mpi.barrier(comm)
 
-    if rank == 0 and os.path.exists(temp_file_path):
-        os.remove(temp_file_path)
+    if rank == 0: #the augmented set stays in the cache for the next run with seed=123
         finish_time = time.time() - begin_time
         print("All rank finished, Total time: %.2f" % (finish_time))
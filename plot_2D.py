@@ -10,7 +10,8 @@ from mpl_toolkits.mplot3d import Axes3D
 from h52vtp import h5_to_vtp
 
 
-def plot_2d_contour(surf_path, surf_name='train_loss', vmin=0.1, vmax=10, vlevel=0.5, show=False):
+def plot_2d_contour(surf_path, surf_name='train_loss', vmin=0.1, vmax=10, vlevel=0.5, proj_path=None, show=False):
+    # proj_path: projected training trajectory of direction.write_pca_direction to overlay
     f = h5py.File(surf_path, 'r')
     x = np.array(f['xcoordinates'][:])
     y = np.array(f['ycoordinates'][:])
@@ -26,6 +27,10 @@ def plot_2d_contour(surf_path, surf_name='train_loss', vmin=0.1, vmax=10, vlevel
     fig = plt.figure()
     CS = plt.contour(X, Y, Z, cmap='summer', levels=np.arange(vmin, vmax, vlevel))
     plt.clabel(CS, inline=1, fontsize=8)
+    if proj_path is not None:
+        fp = h5py.File(proj_path, 'r')
+        plt.plot(fp['proj_xcoord'][:], fp['proj_ycoord'][:], marker='.', color='r')
+        fp.close()
     fig.savefig(surf_path + '_' + surf_name + '_2dcontour.pdf', dpi=300, format='pdf')
 
     f.close()
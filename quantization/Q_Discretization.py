@@ -56,7 +56,7 @@ def weight_discretization(model, L_CONV=(1, 7), L_FC=(1, 7), L_BN=(2, 6)):
             model.layers[idx].set_weights(deepcopy(weights))
             
         elif name == 'Dense': # gleich wie Conv2D, aber anderes Bitschema verwendet
-            weights = model.layers[i1].get_weights()
+            weights = model.layers[idx].get_weights()
             for i1 in range(len(weights)):
                 weights[i1]   = np.clip(weights[i1], min_value_fc, max_value_fc)
                 weights[i1]   = np.round(weights[i1] * BASE**L_FC[1]) * BASE**-L_FC[1]
@@ -0,0 +1,211 @@
+"""
+    TensorFlow version of batch_augment for tf.data pipelines: augment_batch works on
+    a uint8 batch tensor of shape (B, H, W, C) with TF ops only, so that
+    dataset.map(..., num_parallel_calls) runs it without holding the GIL.
+
+    The sub-policies are compiled into tables (get_policy_tables), the sub-policy of
+    every image is drawn at once. As in batch_augment the images of each stage are
+    grouped by their op, each group is gathered, transformed by one batched kernel and
+    scattered back. With the same random draws the results are the same pixels as
+    batch_augment and color_ops.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+from autoaugment import get_auto_policies, get_policy_wrap
+
+TF_OPS = ['inv', 'mrx', 'p&c', 'cut', 'srx', 'sry', 'tlx', 'tly', 'rot', 'pos', 'sol', 'auc', 'eqz', 'con', 'bri', 'clr', 'sha']
+AFFINE_OPS = ['srx', 'sry', 'tlx', 'tly', 'rot']
+
+
+def get_policy_tables(aug_pol, policies=None):
+    # (op indices of TF_OPS, probs, mags), each of shape (sub-policies, stages), with the
+    # ops of get_policy_wrap before and after the sub-policy
+    policies = get_auto_policies(aug_pol) if policies is None else policies
+    prefix, suffix = get_policy_wrap(aug_pol)
+    sub_policies = [] if 'base' in aug_pol else policies
+    chains = [list(prefix) + list(sub) + list(suffix) for sub in sub_policies]
+    if len(chains) == 0:
+        chains = [list(prefix) + list(suffix)]
+
+    for chain in chains:
+        for p in chain:
+            if p['op'] not in TF_OPS:
+                raise Exception('Unknown augment operation: %s' % (p['op']))
+    ops = np.array([[TF_OPS.index(p['op']) for p in chain] for chain in chains], dtype=np.int32)
+    probs = np.array([[p['prob'] for p in chain] for chain in chains], dtype=np.float32)
+    mags = np.array([[p['mag'] for p in chain] for chain in chains], dtype=np.float32)
+    return ops, probs, mags
+
+def pad_crop(x, pad=4):
+    shape = tf.shape(x)
+    x_pad = tf.pad(x, [[0, 0], [pad, pad], [pad, pad], [0, 0]])
+    offsets = tf.random.uniform([shape[0], 2], maxval=2 * pad, dtype=tf.int32)
+    rows = offsets[:, 0, None] + tf.range(shape[1])
+    cols = offsets[:, 1, None] + tf.range(shape[2])
+    x_pad = tf.gather(x_pad, rows, axis=1, batch_dims=1)
+    return tf.gather(x_pad, cols, axis=2, batch_dims=1)
+
+def cutout(x, mags, fcol):
+    # boxes of +-int(H*mag/20) pixels around a random center, filled with the mean color
+    shape = tf.shape(x)
+    box_size = tf.cast(tf.cast(shape[1], tf.float32) * mags / 20., tf.int32)
+    center_w = tf.random.uniform([shape[0]], maxval=shape[2], dtype=tf.int32)
+    center_h = tf.random.uniform([shape[0]], maxval=shape[1], dtype=tf.int32)
+    in_h = tf.abs(tf.range(shape[1])[None, :] - center_h[:, None]) <= box_size[:, None]
+    in_w = tf.abs(tf.range(shape[2])[None, :] - center_w[:, None]) <= box_size[:, None]
+    mask = tf.logical_and(in_h[:, :, None], in_w[:, None, :])
+    return tf.where(mask[..., None], fcol[:, None, None, :], x)
+
+def get_affine_transforms(op, mags, shape):
+    # batch_augment.get_affine_transform for every image, with a random sign each
+    height, width = tf.cast(shape[1], tf.float32), tf.cast(shape[2], tf.float32)
+    signs = tf.where(tf.random.uniform(tf.shape(mags)) < 0.5, -1., 1.)
+    ones, zeros = tf.ones_like(mags), tf.zeros_like(mags)
+    if op == 'srx':
+        data = [ones, signs * 0.3 * mags / 10., zeros, zeros, ones, zeros]
+    elif op == 'sry':
+        data = [ones, zeros, zeros, signs * 0.3 * mags / 10., ones, zeros]
+    elif op == 'tlx':
+        data = [ones, zeros, signs * width * 0.45 * mags / 10., zeros, ones, zeros]
+    elif op == 'tly':
+        data = [ones, zeros, zeros, zeros, ones, signs * height * 0.45 * mags / 10.]
+    elif op == 'rot':
+        angle = -(signs * 30 * mags / 10.) * (np.pi / 180.)
+        center_x, center_y = width / 2., height / 2.
+        a, b, d, e = tf.cos(angle), tf.sin(angle), -tf.sin(angle), tf.cos(angle)
+        data = [a, b, a * -center_x + b * -center_y + center_x, d, e, d * -center_x + e * -center_y + center_y]
+    else:
+        raise Exception('Unknown affine operation: %s' % (op))
+    a, b, c, d, e, f = data #PIL pixel centers, as batch_augment.pil_to_tf_transform
+    return tf.stack([a, b, c + 0.5 * (a + b - 1), d, e, f + 0.5 * (d + e - 1), zeros, zeros], axis=1)
+
+def affine(x, transforms, fcol):
+    # Out-of-image pixels get the mean color: the transform works on x - fcol with fill 0.
+    shift = tf.cast(fcol, tf.float32)[:, None, None, :]
+    out = tf.raw_ops.ImageProjectiveTransformV3(images=tf.cast(x, tf.float32) - shift, transforms=transforms,
+                                                output_shape=tf.shape(x)[1:3], fill_value=0.,
+                                                interpolation='BILINEAR', fill_mode='CONSTANT')
+    return tf.cast(tf.clip_by_value(tf.round(out + shift), 0, 255), tf.uint8)
+
+
+def apply_lut(x, lut):
+    # lut: (B, C, 256) per image and channel, one gather from the flat tables
+    shape = tf.shape(x)
+    idx = (tf.range(shape[0])[:, None, None, None] * shape[3] + tf.range(shape[3])) * 256 + tf.cast(x, tf.int32)
+    return tf.gather(tf.reshape(tf.cast(lut, tf.uint8), [-1]), idx)
+
+def histogram(x):
+    # (B, C, 256) counts of every image and channel
+    shape = tf.shape(x)
+    x_c = tf.reshape(tf.transpose(tf.cast(x, tf.int32), [0, 3, 1, 2]), [shape[0] * shape[3], -1])
+    hist = tf.math.bincount(x_c, minlength=256, maxlength=256, axis=-1, dtype=tf.int64)
+    return tf.reshape(hist, [shape[0], shape[3], 256])
+
+def grayscale(x):
+    # PIL convert('L') in fixed point, as color_ops.grayscale
+    x = tf.cast(x, tf.int32)
+    gray = x[..., 0] * 19595 + x[..., 1] * 38470 + x[..., 2] * 7471 + 0x8000
+    return tf.cast(tf.bitwise.right_shift(gray, 16), tf.uint8)
+
+def blend(degenerate, x, factor):
+    # factor: (B,)
+    degenerate = tf.cast(degenerate, tf.float32)
+    out = degenerate + factor[:, None, None, None] * (tf.cast(x, tf.float32) - degenerate)
+    return tf.cast(tf.clip_by_value(out, 0, 255), tf.uint8)
+
+def posterize(x, bits):
+    mask = tf.bitwise.invert(tf.bitwise.left_shift(1, 8 - bits) - 1)
+    return tf.bitwise.bitwise_and(x, tf.cast(mask & 0xff, tf.uint8)[:, None, None, None])
+
+def solarize(x, threshold):
+    below = tf.cast(x, tf.int32) < threshold[:, None, None, None]
+    return tf.where(below, x, 255 - x)
+
+def autocontrast(x, cutoff=2):
+    hist = histogram(x)
+    cut = (tf.reduce_sum(hist, axis=2, keepdims=True) * cutoff) // 100
+    lo = tf.argmax(tf.cast(tf.cumsum(hist, axis=2) > cut, tf.int32), axis=2)
+    hi = 255 - tf.argmax(tf.cast(tf.cumsum(hist[:, :, ::-1], axis=2) > cut, tf.int32), axis=2)
+
+    valid = hi > lo
+    scale = 255.0 / tf.cast(tf.where(valid, hi - lo, 1), tf.float64)
+    offset = -tf.cast(lo, tf.float64) * scale
+    values = tf.range(256, dtype=tf.float64)
+    lut = tf.clip_by_value(tf.floor(values * scale[..., None] + offset[..., None]), 0, 255) #floor = trunc after the clip
+    lut = tf.where(valid[..., None], lut, values)
+    return apply_lut(x, lut)
+
+def equalize(x):
+    hist = histogram(x)
+    last = 255 - tf.argmax(tf.cast(hist[:, :, ::-1] > 0, tf.int32), axis=2)
+    last_count = tf.gather(hist, last, axis=2, batch_dims=2)
+    step = (tf.reduce_sum(hist, axis=2) - last_count) // 255
+
+    valid = step > 0
+    safe_step = tf.where(valid, step, 1)[..., None]
+    cum = tf.cumsum(hist, axis=2) - hist
+    lut = tf.minimum((safe_step // 2 + cum) // safe_step, 255)
+    lut = tf.where(valid[..., None], lut, tf.range(256, dtype=tf.int64))
+    return apply_lut(x, lut)
+
+def contrast(x, factor):
+    mean = tf.reduce_mean(tf.cast(grayscale(x), tf.float64), axis=[1, 2])
+    return blend(tf.floor(mean + 0.5)[:, None, None, None], x, factor)
+
+def smooth(x):
+    # PIL ImageFilter.SMOOTH, as color_ops.smooth, the border is kept
+    xf = tf.cast(x, tf.float32)
+    shape = tf.shape(x)
+    total = 5 * xf[:, 1:-1, 1:-1]
+    for dh in [-1, 0, 1]:
+        for dw in [-1, 0, 1]:
+            if dh != 0 or dw != 0:
+                total = total + xf[:, 1+dh:shape[1]-1+dh, 1+dw:shape[2]-1+dw]
+    inner = tf.pad(tf.cast(tf.clip_by_value(total / 13. + 0.5, 0, 255), tf.uint8), [[0, 0], [1, 1], [1, 1], [0, 0]])
+    border = tf.pad(tf.zeros(shape[1:3] - 2, dtype=tf.bool), [[1, 1], [1, 1]], constant_values=True)
+    return tf.where(border[None, :, :, None], x, inner)
+
+def get_factor(mags):
+    return 0.1 + 1.8 * mags / 10.
+
+# op code -> kernel(x, mags, fcol) on the gathered images of the op
+TF_KERNELS = {
+    'inv': lambda x, mags, fcol: 255 - x,
+    'mrx': lambda x, mags, fcol: tf.image.flip_left_right(x),
+    'p&c': lambda x, mags, fcol: pad_crop(x),
+    'cut': lambda x, mags, fcol: cutout(x, mags, fcol),
+    'pos': lambda x, mags, fcol: posterize(x, tf.cast(4 + 4 * mags / 10., tf.int32)),
+    'sol': lambda x, mags, fcol: solarize(x, tf.cast(255 * mags / 10., tf.int32)),
+    'auc': lambda x, mags, fcol: autocontrast(x, cutoff=2),
+    'eqz': lambda x, mags, fcol: equalize(x),
+    'con': lambda x, mags, fcol: contrast(x, get_factor(mags)),
+    'bri': lambda x, mags, fcol: blend(0., x, get_factor(mags)),
+    'clr': lambda x, mags, fcol: blend(grayscale(x)[..., None], x, get_factor(mags)),
+    'sha': lambda x, mags, fcol: blend(smooth(x), x, get_factor(mags)),
+}
+for op in AFFINE_OPS:
+    TF_KERNELS[op] = (lambda op: lambda x, mags, fcol: affine(x, get_affine_transforms(op, mags, tf.shape(x)), fcol))(op)
+
+def apply_op(x, op, selected, mags, fcol):
+    # runs the kernel of op on the selected images only
+    idx = tf.where(selected)
+    def run():
+        out = TF_KERNELS[op](tf.gather_nd(x, idx), tf.gather_nd(mags, idx), tf.gather_nd(fcol, idx))
+        return tf.tensor_scatter_nd_update(x, idx, out)
+    return tf.cond(tf.size(idx) > 0, run, lambda: x)
+
+def augment_batch(x, tables):
+    # x: uint8 (B, H, W, C), tables: get_policy_tables, returns the augmented uint8 batch
+    ops, probs, mags = tables
+    num = tf.shape(x)[0]
+    fcol = tf.cast(tf.reduce_mean(tf.cast(x, tf.float32), axis=[1, 2]), tf.uint8) #fill color, as add_autoaugment
+    policy_idx = tf.random.uniform([num], maxval=len(ops), dtype=tf.int32)
+    for stage in range(ops.shape[1]):
+        stage_ops = tf.gather(ops[:, stage], policy_idx)
+        stage_mags = tf.gather(mags[:, stage], policy_idx)
+        active = tf.random.uniform([num]) < tf.gather(probs[:, stage], policy_idx)
+        for op_idx in np.unique(ops[:, stage]): #only the ops this stage can draw
+            x = apply_op(x, TF_OPS[op_idx], tf.logical_and(active, tf.equal(stage_ops, op_idx)), stage_mags, fcol)
+    return x
@@ -3,9 +3,12 @@ import os
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
 import glob
+import json
 import math
+import re
 import time
 import timeit
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import tensorflow as tf
@@ -24,29 +27,73 @@ feature_description = {
 def _parse_function(example_proto):
     return tf.io.parse_single_example(example_proto, feature_description)
 
-def write_record(file_path, x_set, y_set):
-
-    split_size = 65536
+def write_record(file_path, x_set, y_set, block_size=None, compression=None, split_size=65536):
+    # block_size=None: one tf.train.Example per shard (legacy layout)
+    # block_size: examples of block_size images each, readable one block at a time and
+    #             in parallel with load_record_dataset, an index file is written as well
+    # compression: None, 'GZIP' or 'ZLIB'
     split_num = math.ceil(len(x_set) / split_size)
+    legacy = block_size is None and compression is None
+    block_size = split_size if block_size is None else block_size
+    options = tf.io.TFRecordOptions(compression_type=compression) if compression is not None else None
 
+    shards = []
     for i in range(split_num):
         file_path_split = file_path + '-%05d-of-%05d' % (i, split_num)
         x_split = x_set[split_size*i:min(split_size*(i+1), len(x_set))]
         y_split = y_set[split_size*i:min(split_size*(i+1), len(y_set))]
-        with tf.io.TFRecordWriter(file_path_split) as file_writer:
-            record_bytes = tf.train.Example(features=tf.train.Features(feature={
-                "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[x_split.tobytes()])),
-                "label": tf.train.Feature(int64_list=tf.train.Int64List(value=y_split)),
-                "shape": tf.train.Feature(int64_list=tf.train.Int64List(value=list(x_split.shape))),
-                "imgdt": tf.train.Feature(bytes_list=tf.train.BytesList(value=[str(x_split.dtype).encode()])),
-                "labdt": tf.train.Feature(bytes_list=tf.train.BytesList(value=[str(y_split.dtype).encode()])),
-            })).SerializeToString()
-            file_writer.write(record_bytes)
+        with tf.io.TFRecordWriter(file_path_split, options=options) as file_writer:
+            for start in range(0, len(x_split), block_size):
+                file_writer.write(serialize_block(x_split[start:start+block_size], y_split[start:start+block_size]))
+        shards.append({'file': os.path.basename(file_path_split), 'num_samples': len(x_split)})
+
+    if not legacy:
+        write_index(file_path, {
+            'block_size': block_size,
+            'compression': compression,
+            'num_samples': len(x_set),
+            'shape': list(x_set.shape[1:]),
+            'imgdt': str(x_set.dtype),
+            'labdt': str(np.asarray(y_set).dtype),
+            'shards': shards,
+        })
+
+def serialize_block(x_block, y_block):
+    return tf.train.Example(features=tf.train.Features(feature={
+        "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[x_block.tobytes()])),
+        "label": tf.train.Feature(int64_list=tf.train.Int64List(value=y_block)),
+        "shape": tf.train.Feature(int64_list=tf.train.Int64List(value=list(x_block.shape))),
+        "imgdt": tf.train.Feature(bytes_list=tf.train.BytesList(value=[str(x_block.dtype).encode()])),
+        "labdt": tf.train.Feature(bytes_list=tf.train.BytesList(value=[str(y_block.dtype).encode()])),
+    })).SerializeToString()
+
+def get_index_path(file_path):
+    return file_path + '.index.json'
+
+def write_index(file_path, index):
+    with open(get_index_path(file_path), 'w') as f:
+        json.dump(index, f, indent=4)
+
+def read_index(file_path):
+    # None for records without index, i.e. the legacy layout
+    index_path = get_index_path(file_path)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        return json.load(f)
+
+def get_record_files(file_path):
+    # shard files of a record, without the index file
+    split_pattern = re.compile(r'-\d{5}-of-\d{5}$')
+    return sorted([path for path in glob.glob(file_path + '-*-of-*') if split_pattern.search(path)])
+
+def get_record_path(record_file):
+    return re.sub(r'-\d{5}-of-\d{5}$', '', record_file)
 
 def read_record(file_path, dataset):
     assert os.path.exists(file_path), 'Dataset does not exsist, please check path: ' + file_path
-    train_files = glob.glob(file_path + dataset + '-train.tfrecord*')
-    test_files = glob.glob(file_path + dataset + '-test.tfrecord*')
+    train_files = get_record_files(file_path + dataset + '-train.tfrecord')
+    test_files = get_record_files(file_path + dataset + '-test.tfrecord')
 
     assert (len(train_files) > 0 and len(test_files) > 0), 'Train/Test data is missing, please check!'
     assert (int(train_files[0].split('-')[-1]) == len(train_files) and int(test_files[0].split('-')[-1]) == len(test_files)), 'Several Train/Test records are missing, please check!'
@@ -56,22 +103,89 @@ def read_record(file_path, dataset):
 
     return train_image, train_label, test_image, test_label
 
-def extract_record(file_list):
-    image_list = None
-    label_list = None
-    for record_file in file_list:
-        raw_record = tf.data.TFRecordDataset(record_file)
-        parsed_record = raw_record.map(_parse_function)
-        for features in parsed_record:
-            imgdt = features['imgdt'].numpy().decode()
-            labdt = features['labdt'].numpy().decode()
-            image = np.frombuffer(features['image'].numpy(), dtype=imgdt).reshape(features['shape'].numpy())
-            label = features['label'].numpy().astype(labdt)
-            image_list = image if image_list is None else np.concatenate((image_list, image), axis=0)
-            label_list = label if label_list is None else np.concatenate((label_list, label), axis=0)
-    
+def read_blocks(record_file, compression=None):
+    # (images, labels) of every example of one shard
+    blocks = []
+    for features in tf.data.TFRecordDataset(record_file, compression_type=compression).map(_parse_function):
+        imgdt = features['imgdt'].numpy().decode()
+        images = np.frombuffer(features['image'].numpy(), dtype=imgdt).reshape(features['shape'].numpy())
+        labels = features['label'].numpy().astype(features['labdt'].numpy().decode())
+        blocks.append((images, labels))
+    return blocks
+
+def extract_record(file_list, num_workers=None):
+    # Records with an index file are parsed shard by shard in parallel directly into
+    # one preallocated array, in the order of file_list. Legacy records (one example per
+    # shard, no index) are decoded once per shard in parallel and copied into the
+    # final array, their sizes are only known after decoding.
+    num_workers = min(len(file_list), os.cpu_count() or 1) if num_workers is None else num_workers
+    index = read_index(get_record_path(file_list[0]))
+
+    if index is None:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            blocks = [block for blocks in executor.map(read_blocks, file_list) for block in blocks]
+        assert len(blocks) > 0, 'No records found in: ' + str(file_list)
+        shape, imgdt, labdt = blocks[0][0].shape[1:], blocks[0][0].dtype, blocks[0][1].dtype
+        assert all([b[0].shape[1:] == shape and b[0].dtype == imgdt and b[1].dtype == labdt for b in blocks]), 'Records of different shape/dtype, please check!'
+
+        total = sum([len(b[0]) for b in blocks])
+        image_list = np.empty((total,) + shape, dtype=imgdt)
+        label_list = np.empty((total,), dtype=labdt)
+        start = 0
+        while len(blocks) > 0:
+            images, labels = blocks.pop(0) #the decoded shards are freed one by one
+            image_list[start:start+len(images)] = images
+            label_list[start:start+len(images)] = labels
+            start += len(images)
+        return image_list, label_list
+
+    compression = index['compression']
+    sizes = {shard['file']: shard['num_samples'] for shard in index['shards']}
+    shard_sizes = [sizes[os.path.basename(record_file)] for record_file in file_list]
+    shape, imgdt, labdt = tuple(index['shape']), index['imgdt'], index['labdt']
+
+    total = sum(shard_sizes)
+    image_list = np.empty((total,) + shape, dtype=imgdt)
+    label_list = np.empty((total,), dtype=labdt)
+
+    offsets = np.cumsum([0] + shard_sizes)
+
+    def read_shard(idx):
+        start = offsets[idx]
+        for features in tf.data.TFRecordDataset(file_list[idx], compression_type=compression).map(_parse_function):
+            num = int(features['shape'][0])
+            image_list[start:start+num] = np.frombuffer(features['image'].numpy(), dtype=imgdt).reshape(features['shape'].numpy())
+            label_list[start:start+num] = features['label'].numpy()
+            start += num
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(read_shard, range(len(file_list)))) #raises the exceptions of the workers
+
     return image_list, label_list
 
+def load_record_dataset(file_path, cycle_length=None):
+    # tf.data dataset of (image, label) examples of a block record (see write_record),
+    # the shards are read interleaved and the blocks are decoded in parallel.
+    index = read_index(file_path)
+    assert index is not None, 'Record has no index file, please rewrite it with block_size: ' + file_path
+    record_files = get_record_files(file_path)
+    assert len(record_files) == len(index['shards']), 'Several records are missing, please check!'
+
+    shape = index['shape']
+    imgdt = tf.as_dtype(index['imgdt'])
+    labdt = tf.as_dtype(index['labdt'])
+
+    def parse_block(example_proto):
+        features = tf.io.parse_single_example(example_proto, feature_description)
+        image = tf.reshape(tf.io.decode_raw(features['image'], imgdt), [-1] + shape)
+        label = tf.cast(features['label'], labdt)
+        return image, label
+
+    files = tf.data.Dataset.from_tensor_slices(record_files)
+    dataset = files.interleave(lambda record_file: tf.data.TFRecordDataset(record_file, compression_type=index['compression'] or ''),
+                               cycle_length=cycle_length, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.map(parse_block, num_parallel_calls=tf.data.AUTOTUNE).unbatch()
+    return dataset
 
 
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+"""
+    Optional profiling hooks for the surface pipeline.
+    Stage_Tracer records wall time, RSS, peak RSS and TF allocator statistics for named
+    stages (data load, direction creation, set_weights, eval, write) and writes
+    them to <trace_dir>/stages.json. It can also capture a tf.profiler trace for a
+    window of grid points, which ends up in <trace_dir>/plugins/profile/ and can be
+    opened with TensorBoard.
+    With trace_dir=None every hook is a no-op.
+"""
+
+import contextlib
+import json
+import os
+import time
+
+import tensorflow as tf
+
+try:
+    import resource
+except ImportError:
+    resource = None #not available on Windows
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def get_rss_mb():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (IOError, ValueError, AttributeError):
+        return -1.
+
+def get_peak_rss_mb():
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10 #kB on linux
+    if psutil is not None and hasattr(psutil.Process().memory_info(), 'peak_wset'):
+        return psutil.Process().memory_info().peak_wset / 2**20
+    return -1.
+
+def reset_peak_rss():
+    # Resets the peak RSS (VmHWM) of the process, linux only. True on success.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+def get_hwm_mb():
+    # VmHWM, the peak RSS since the last reset_peak_rss
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10 #kB
+    except (IOError, ValueError):
+        pass
+    return -1.
+
+def get_tf_device():
+    gpus = tf.config.list_logical_devices('GPU')
+    return gpus[0].name if len(gpus) > 0 else 'CPU:0'
+
+def get_tf_memory_mb(device):
+    try:
+        info = tf.config.experimental.get_memory_info(device)
+    except (ValueError, AttributeError):
+        return -1., -1. #allocator stats are not supported for this device
+    return info['current'] / 2**20, info['peak'] / 2**20
+
+def reset_tf_memory(device):
+    try:
+        tf.config.experimental.reset_memory_stats(device)
+    except (ValueError, AttributeError):
+        pass
+
+
+class Stage_Tracer(object):
+
+    def __init__(self, trace_dir=None, trace_points=None):
+        self.trace_dir = trace_dir
+        self.trace_points = trace_points
+        self.profiling = False
+        self.stages = {}
+        self.peak_rss = -1. #process peak RSS, VmHWM is reset by every stage
+        self.open_peaks = [] #peak RSS so far of the enclosing open stages
+
+        if self.trace_dir is not None:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            self.device = get_tf_device()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.trace_dir is None:
+            yield
+            return
+
+        reset_tf_memory(self.device)
+        self.update_peak(max(get_peak_rss_mb(), get_hwm_mb())) #before the reset, for the enclosing stages
+        hwm_reset = reset_peak_rss()
+        peak_start = get_peak_rss_mb()
+        rss_start = get_rss_mb()
+        self.open_peaks.append(rss_start)
+        start = time.time()
+        try:
+            with tf.profiler.experimental.Trace(name):
+                yield
+        finally:
+            nested_peak = self.open_peaks.pop() #peaks of nested stages
+        stage_time = time.time() - start
+        rss = get_rss_mb()
+        tf_current, tf_peak = get_tf_memory_mb(self.device)
+
+        # Peak RSS of the stage: VmHWM since the reset at the start of the stage.
+        # Without it (not linux) ru_maxrss only shows peaks above the previous process
+        # peak, otherwise the larger of the RSS at start and exit is a lower bound.
+        if hwm_reset:
+            peak = get_hwm_mb()
+        else:
+            peak_end = get_peak_rss_mb()
+            peak = peak_end if peak_end > peak_start else max(rss_start, rss)
+        peak = max(peak, nested_peak)
+        self.update_peak(peak)
+
+        s = self.stages.setdefault(name, {'count': 0, 'time': 0., 'max_time': 0., 'rss_delta_mb': 0., 'rss_mb': 0., 'peak_rss_mb': 0.,
+                                          'tf_current_mb': 0., 'tf_peak_mb': 0.})
+        s['count'] += 1
+        s['time'] += stage_time
+        s['max_time'] = max(s['max_time'], stage_time)
+        s['rss_delta_mb'] = max(s['rss_delta_mb'], rss - rss_start)
+        s['rss_mb'] = max(s['rss_mb'], rss)
+        s['peak_rss_mb'] = max(s['peak_rss_mb'], peak)
+        s['tf_current_mb'] = max(s['tf_current_mb'], tf_current)
+        s['tf_peak_mb'] = max(s['tf_peak_mb'], tf_peak)
+
+    def update_peak(self, peak):
+        # a peak inside a nested stage is also a peak of the enclosing stages
+        self.peak_rss = max(self.peak_rss, peak)
+        self.open_peaks = [max(p, peak) for p in self.open_peaks]
+
+    def point_begin(self, idx):
+        if self.trace_dir is None or self.trace_points is None:
+            return
+        if idx == self.trace_points[0] and not self.profiling:
+            tf.profiler.experimental.start(self.trace_dir)
+            self.profiling = True
+        elif idx == self.trace_points[1] and self.profiling:
+            self.stop_profiler()
+
+    def stop_profiler(self):
+        if self.profiling:
+            tf.profiler.experimental.stop()
+            self.profiling = False
+
+    def save(self):
+        if self.trace_dir is None:
+            return
+        self.stop_profiler()
+
+        summary = {
+            'device': self.device,
+            'peak_rss_mb': max(self.peak_rss, get_peak_rss_mb()),
+            'trace_points': list(self.trace_points) if self.trace_points is not None else None,
+            'stages': self.stages,
+        }
+        trace_path = os.path.join(self.trace_dir, 'stages.json')
+        with open(trace_path, 'w') as f:
+            json.dump(summary, f, indent=4, sort_keys=True)
+        print('Trace saved: %s' % trace_path)